@@ -0,0 +1,164 @@
+import os
+import sys
+import copy
+import json
+import time
+import resource
+import itertools
+import traceback
+import torch
+import torch.multiprocessing as mp
+from solver import Solver
+from data_loader import get_loader
+from data_loader import reserve_worker_cpus
+from memory import PeakSampler
+from memory import tree_memory_mb
+
+
+# Fields of the configuration that a tuning profile sets.
+PROFILE_KEYS = ['num_threads', 'num_workers', 'pin_workers', 'batch_size']
+
+
+def apply_cpu_config(config):
+    """Set torch's thread count and, with pin_workers, split the cores; return the workers' cores."""
+    worker_cpus = None
+    if config.pin_workers and config.num_workers > 0:
+        worker_cpus = reserve_worker_cpus(config.num_workers)
+    if config.num_threads:
+        torch.set_num_threads(config.num_threads)
+    return worker_cpus
+
+
+def load_profile(config):
+    """Override the configuration with a tuning profile written by --mode autotune."""
+    with open(config.tune_profile, 'r') as f:
+        profile = json.load(f)
+    for key in PROFILE_KEYS:
+        setattr(config, key, profile[key])
+    print('Loaded CPU profile from {}: {}'.format(config.tune_profile,
+                                                   ', '.join('{}={}'.format(k, profile[k]) for k in PROFILE_KEYS)))
+
+
+def run_trial(config, queue):
+    """Time get_loader and Solver.train for one configuration; runs in its own process."""
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        queue.put(time_trial(config))
+    except Exception as e:
+        traceback.print_exc()
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+class TimedLoader(object):
+    """Wraps a data loader and records the time each batch is handed out."""
+
+    def __init__(self, data_loader):
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.times = []
+
+    def __iter__(self):
+        for batch in self.data_loader:
+            self.times.append(time.time())
+            yield batch
+
+    def __len__(self):
+        return len(self.data_loader)
+
+
+def time_trial(config):
+    """Return the loader and training throughput and the peak memory of this process and its workers."""
+    worker_cpus = apply_cpu_config(config)
+    celeba_loader = get_loader(config.celeba_image_dir, config.attr_path, config.selected_attrs, 'train',
+                               config.celeba_crop_size, config.image_size, config.batch_size,
+                               'CelebA', config.num_workers, config.shard_dir, config.shuffle_buffer, worker_cpus)
+
+    # Loader throughput on its own, after the workers have started and filled their prefetch queues.
+    data_iter = iter(celeba_loader)
+    for k in range(config.tune_warmup + config.tune_iters):
+        if k == config.tune_warmup:
+            start_time = time.time()
+        try:
+            next(data_iter)
+        except StopIteration:
+            data_iter = iter(celeba_loader)
+            next(data_iter)
+    loader_ips = config.tune_iters * config.batch_size / (time.time() - start_time)
+    del data_iter
+
+    # Training throughput over the steady-state iterations only, without sampling, checkpoints or lr decay.
+    # Batch 0 is train()'s fixed sample batch and batch k the one of iteration k, so the timed window
+    # starts when iteration tune_warmup + 1 fetches its batch.
+    config.num_iters = config.tune_warmup + config.tune_iters
+    config.resume_iters = None
+    config.use_tensorboard = False
+    config.eval_fid = False
+    config.log_step = config.sample_step = config.model_save_step = config.lr_update_step = config.num_iters + 1
+    timed_loader = TimedLoader(celeba_loader)
+    solver = Solver(timed_loader, config)
+    solver.train()
+    train_ips = config.tune_iters * config.batch_size / (time.time() - timed_loader.times[config.tune_warmup + 1])
+
+    # Peak memory in a separate, untimed pass: polling /proc slows training down noticeably.
+    # The whole process tree is sampled, as loader workers are alive (not yet reaped) while they use memory.
+    if not os.path.isdir('/proc'):
+        return {'loader_images/s': loader_ips, 'train_images/s': train_ips,
+                'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    sampler = PeakSampler(tree_memory_mb, interval=0.1)
+    solver.num_iters = max(2, config.tune_warmup)
+    solver.train()
+    peak_memory = sampler.reset()
+    sampler.stop()
+    return {'loader_images/s': loader_ips, 'train_images/s': train_ips, 'peak_memory_mb': peak_memory}
+
+
+def autotune(config):
+    """Search thread, worker, pinning and batch size settings and save the fastest as a profile."""
+    ctx = mp.get_context('spawn')
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    num_threads = config.tune_threads or sorted(set([1, max(1, num_cpus // 2), num_cpus]))
+    trials = []
+    errors = []
+    for batch_size, threads, workers, pin in itertools.product(config.tune_batch_sizes, num_threads,
+                                                               config.tune_workers, [False, True]):
+        if pin and workers == 0:
+            continue
+        trial = copy.deepcopy(config)
+        trial.batch_size, trial.num_threads, trial.num_workers, trial.pin_workers = batch_size, threads, workers, pin
+
+        # A fresh process per trial isolates thread pools and peak memory.
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_trial, args=(trial, queue))
+        p.start()
+        p.join()
+        result = queue.get() if p.exitcode == 0 else {'error': 'process exited with code {}'.format(p.exitcode)}
+        if 'error' in result:
+            errors.append(result['error'])
+            print('Trial batch_size={} threads={} workers={} pin={} failed: {}'.format(
+                batch_size, threads, workers, pin, result['error']))
+            continue
+        result.update(dict((key, getattr(trial, key)) for key in PROFILE_KEYS))
+        trials.append(result)
+        print('batch_size={} threads={} workers={} pin={}: loader {:.1f} images/s, train {:.1f} images/s, '
+              'peak memory {:.0f} MB'.format(batch_size, threads, workers, pin, result['loader_images/s'],
+                                          result['train_images/s'], result['peak_memory_mb']))
+
+    if not trials:
+        raise RuntimeError('All {} trials failed; the first error was: {}'.format(
+            len(errors), errors[0] if errors else 'no trials to run'))
+    fits = [t for t in trials if config.tune_memory_mb is None or t['peak_memory_mb'] <= config.tune_memory_mb]
+    if not fits:
+        raise RuntimeError('No configuration fits in {} MB.'.format(config.tune_memory_mb))
+    best = max(fits, key=lambda t: t['train_images/s'])
+
+    profile = dict((key, best[key]) for key in PROFILE_KEYS)
+    profile['train_images/s'] = best['train_images/s']
+    profile['peak_memory_mb'] = best['peak_memory_mb']
+    profile['trials'] = trials
+    profile_dir = os.path.dirname(config.tune_profile)
+    if profile_dir and not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    with open(config.tune_profile, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print('Saved the fastest configuration ({}) into {}...'.format(
+        ', '.join('{}={}'.format(k, best[k]) for k in PROFILE_KEYS), config.tune_profile))
@@ -0,0 +1,209 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+from model import Generator
+from model import Discriminator
+
+
+class ActivationMeter(object):
+    """Count the bytes autograd saves for backward while the meter is active."""
+
+    def __init__(self):
+        self.saved_bytes = 0
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+
+    def pack(self, tensor):
+        self.saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    def __enter__(self):
+        self.saved_bytes = 0
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+
+def generator_step(G, x_real, c_org, c_trg):
+    """Run the reconstruction part of a G step: two G forwards and one backward."""
+    x_fake = G(x_real, c_trg)
+    x_reconst = G(x_fake, c_org)
+    g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
+    G.zero_grad()
+    g_loss_rec.backward()
+
+
+def bench_checkpoint(config):
+    """Report activation memory and G step throughput per checkpoint mode and batch size."""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('{:>10} {:>6} {:>14} {:>12}'.format('checkpoint', 'batch', 'activations MB', 'images/s'))
+    for mode in config.g_checkpoint:
+        G = Generator(config.g_conv_dim, config.c_dim, config.g_repeat_num, mode).to(device)
+        for batch_size in config.batch_sizes:
+            x_real = torch.randn(batch_size, 3, config.image_size, config.image_size, device=device)
+            c_org = torch.randint(0, 2, (batch_size, config.c_dim), device=device).float()
+            c_trg = 1 - c_org
+
+            # Measure saved activations on a separate, untimed step.
+            with ActivationMeter() as meter:
+                generator_step(G, x_real, c_org, c_trg)
+            for _ in range(config.warmup):
+                generator_step(G, x_real, c_org, c_trg)
+
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start_time = time.time()
+            for _ in range(config.num_iters):
+                generator_step(G, x_real, c_org, c_trg)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            images_per_sec = batch_size * config.num_iters / (time.time() - start_time)
+            print('{:>10} {:>6} {:>14.1f} {:>12.2f}'.format(mode, batch_size, meter.saved_bytes / 2**20, images_per_sec))
+
+
+def train_step(G, D, G_train, D_train, x_real, c_org, c_trg):
+    """Run one D update and one G update as Solver.train does, with an eager gradient penalty."""
+    out_src, out_cls = D_train(x_real)
+    d_loss = - torch.mean(out_src) + F.binary_cross_entropy_with_logits(out_cls, c_org)
+    x_fake = G_train(x_real, c_trg)
+    out_src, _ = D_train(x_fake.detach())
+    d_loss = d_loss + torch.mean(out_src)
+    alpha = torch.rand(x_real.size(0), 1, 1, 1, device=x_real.device)
+    x_hat = (alpha * x_real + (1 - alpha) * x_fake.detach()).requires_grad_(True)
+    out_src, _ = D(x_hat)
+    dydx = torch.autograd.grad(out_src.sum(), x_hat, create_graph=True)[0]
+    d_loss = d_loss + 10 * torch.mean((dydx.view(dydx.size(0), -1).norm(dim=1) - 1) ** 2)
+    D.zero_grad()
+    d_loss.backward()
+
+    x_fake = G_train(x_real, c_trg)
+    out_src, out_cls = D_train(x_fake)
+    x_reconst = G_train(x_fake, c_org)
+    g_loss = - torch.mean(out_src) + F.binary_cross_entropy_with_logits(out_cls, c_trg) \
+        + 10 * torch.mean(torch.abs(x_real - x_reconst))
+    G.zero_grad()
+    g_loss.backward()
+
+
+def bench_compile(config):
+    """Report inductor compile time and steady-state speedup of the training step."""
+    import os
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(config.compile_cache_dir))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    G = Generator(config.g_conv_dim, config.c_dim, config.g_repeat_num).to(device)
+    D = Discriminator(config.image_size, config.d_conv_dim, config.c_dim, config.d_repeat_num).to(device)
+    x_real = torch.randn(config.batch_size, 3, config.image_size, config.image_size, device=device)
+    c_org = torch.randint(0, 2, (config.batch_size, config.c_dim), device=device).float()
+    c_trg = 1 - c_org
+
+    results = {}
+    for name, G_train, D_train in (('eager', G, D), ('compiled', torch.compile(G), torch.compile(D))):
+        start_time = time.time()
+        for _ in range(max(config.warmup, 1)):
+            train_step(G, D, G_train, D_train, x_real, c_org, c_trg)
+        warmup_time = time.time() - start_time
+        start_time = time.time()
+        for _ in range(config.num_iters):
+            train_step(G, D, G_train, D_train, x_real, c_org, c_trg)
+        results[name] = (warmup_time, (time.time() - start_time) / config.num_iters)
+        print('{:>8}: warm-up {:.2f}s, {:.3f}s/iter, {:.2f} images/s'.format(
+            name, warmup_time, results[name][1], config.batch_size / results[name][1]))
+    print('Compile time (warm-up difference): {:.2f}s, steady-state speedup: {:.2f}x'.format(
+        results['compiled'][0] - results['eager'][0], results['eager'][1] / results['compiled'][1]))
+
+
+def first_image(config, queue):
+    """Time model loading plus the first G forward in a fresh process."""
+    import os
+    import sys
+    import resource
+    from solver import Solver
+
+    sys.stdout = open(os.devnull, 'w')
+    start_time = time.time()
+    solver = Solver(None, config)
+    solver.load_generator()
+    x = torch.randn(1, 3, solver.image_size, solver.image_size, device=solver.device)
+    with torch.no_grad():
+        solver.G(x, torch.zeros(1, solver.c_dim, device=solver.device))
+    queue.put((time.time() - start_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def bench_load(config):
+    """Compare time-to-first-image of the pickled checkpoints against the memory-mapped export."""
+    import copy
+    import torch.multiprocessing as mp
+    from main import get_parser
+
+    ctx = mp.get_context('spawn')
+    solver_config = get_parser().parse_args([])
+    for name in ('c_dim', 'image_size', 'g_conv_dim', 'd_conv_dim', 'g_repeat_num', 'd_repeat_num',
+                 'model_save_dir', 'test_iters'):
+        setattr(solver_config, name, getattr(config, name))
+    solver_config.use_tensorboard = False
+
+    for name, export_path in (('checkpoint', None), ('export', config.export_path)):
+        trial = copy.deepcopy(solver_config)
+        trial.export_path = export_path
+        times = []
+        for _ in range(config.num_iters):
+            queue = ctx.Queue()
+            p = ctx.Process(target=first_image, args=(trial, queue))
+            p.start()
+            p.join()
+            times.append(queue.get())
+        print('{:>10}: time-to-first-image {:.3f}s (best of {}), peak RSS {:.0f} MB'.format(
+            name, min(t for t, _ in times), config.num_iters, min(rss for _, rss in times)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    # Model configuration.
+    model_parser = argparse.ArgumentParser(add_help=False)
+    model_parser.add_argument('--c_dim', type=int, default=5, help='dimension of domain labels (1st dataset)')
+    model_parser.add_argument('--image_size', type=int, default=128, help='image resolution')
+    model_parser.add_argument('--g_conv_dim', type=int, default=64, help='number of conv filters in the first layer of G')
+    model_parser.add_argument('--g_repeat_num', type=int, default=6, help='number of residual blocks in G')
+    model_parser.add_argument('--num_iters', type=int, default=5, help='number of timed iterations per configuration')
+    model_parser.add_argument('--warmup', type=int, default=1, help='number of untimed iterations per configuration')
+
+    # Activation checkpointing.
+    checkpoint_parser = subparsers.add_parser('checkpoint', parents=[model_parser],
+                                              help='G activation memory and throughput versus batch size')
+    checkpoint_parser.add_argument('--g_checkpoint', nargs='+', default=['none', 'bottleneck', 'all'])
+    checkpoint_parser.add_argument('--batch_sizes', type=int, nargs='+', default=[4, 8, 16, 32])
+    checkpoint_parser.set_defaults(func=bench_checkpoint)
+
+    # Compiled training step.
+    compile_parser = subparsers.add_parser('compile', parents=[model_parser],
+                                           help='inductor compile time and steady-state speedup of a D+G step')
+    compile_parser.add_argument('--d_conv_dim', type=int, default=64, help='number of conv filters in the first layer of D')
+    compile_parser.add_argument('--d_repeat_num', type=int, default=6, help='number of strided conv layers in D')
+    compile_parser.add_argument('--batch_size', type=int, default=16, help='mini-batch size')
+    compile_parser.add_argument('--compile_cache_dir', type=str, default='stargan/compile_cache', help='persistent inductor cache')
+    compile_parser.set_defaults(func=bench_compile)
+
+    # Model loading.
+    load_parser = subparsers.add_parser('load', parents=[model_parser],
+                                        help='time-to-first-image of pickled checkpoints versus --mode export')
+    load_parser.add_argument('--d_conv_dim', type=int, default=64, help='number of conv filters in the first layer of D')
+    load_parser.add_argument('--d_repeat_num', type=int, default=6, help='number of strided conv layers in D')
+    load_parser.add_argument('--model_save_dir', type=str, default='stargan/models')
+    load_parser.add_argument('--test_iters', type=int, default=200000, help='checkpoint step')
+    load_parser.add_argument('--export_path', type=str, required=True, help='file written by main.py --mode export')
+    load_parser.set_defaults(func=bench_load)
+
+    config = parser.parse_args()
+    print(config)
+    config.func(config)
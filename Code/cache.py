@@ -0,0 +1,117 @@
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import torch
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TranslationCache(object):
+    """Content-addressed cache of Generator outputs with an in-memory LRU tier and an on-disk tier."""
+
+    def __init__(self, model_id, mem_items=1024, disk_dir=None, disk_bytes=1 << 30):
+        """Initialize both tiers; model_id identifies the checkpoint the outputs came from."""
+        self.model_id = model_id
+        self.mem_items = mem_items
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+        if disk_dir is not None:
+            # Several processes (e.g. translate.py workers) may share disk_dir, so tolerate races on it.
+            os.makedirs(disk_dir, exist_ok=True)
+            # Rebuild the disk index, least recently used first.
+            entries = []
+            for entry in os.scandir(disk_dir):
+                if not entry.name.endswith('.pt'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, entry.name[:-3], stat.st_size))
+            for _, key, size in sorted(entries):
+                self.disk[key] = size
+                self.disk_size += size
+
+    def key(self, x, c):
+        """Hash one preprocessed input image, its target label and the model identity."""
+        digest = hashlib.sha256(self.model_id.encode('ascii'))
+        for t in (x, c):
+            t = t.detach().to('cpu', torch.float32).contiguous()
+            digest.update(str(tuple(t.shape)).encode('ascii'))
+            digest.update(t.numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached output for key, or None on a miss."""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits_mem += 1
+            return self.memory[key]
+        if key in self.disk:
+            path = os.path.join(self.disk_dir, key + '.pt')
+            try:
+                value = torch.load(path)
+                os.utime(path)
+            except (OSError, EOFError, RuntimeError, pickle.UnpicklingError):
+                # Evicted by another process, or left unreadable by an interrupted writer: a miss.
+                self.disk_size -= self.disk.pop(key)
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+            self.hits_disk += 1
+            self.put_memory(key, value)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store an output in both tiers, evicting least recently used entries."""
+        value = value.detach().cpu().clone()
+        self.put_memory(key, value)
+        if self.disk_dir is not None and key not in self.disk:
+            # Write under a private name and rename, so readers never see a partly written file.
+            path = os.path.join(self.disk_dir, key + '.pt')
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            torch.save(value, tmp_path)
+            os.replace(tmp_path, path)
+            self.disk[key] = os.path.getsize(path)
+            self.disk_size += self.disk[key]
+            while self.disk_size > self.disk_bytes and len(self.disk) > 1:
+                old_key, size = self.disk.popitem(last=False)
+                try:
+                    os.remove(os.path.join(self.disk_dir, old_key + '.pt'))
+                except FileNotFoundError:
+                    pass  # Already evicted by another process.
+                self.disk_size -= size
+
+    def put_memory(self, key, value):
+        """Store an output in the in-memory LRU tier."""
+        if self.mem_items <= 0:
+            return
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.mem_items:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        """Return hit and miss counters and the overall hit rate."""
+        lookups = self.hits_mem + self.hits_disk + self.misses
+        return {'cache/hits_mem': self.hits_mem,
+                'cache/hits_disk': self.hits_disk,
+                'cache/misses': self.misses,
+                'cache/hit_rate': (self.hits_mem + self.hits_disk) / float(max(lookups, 1))}
@@ -3,6 +3,11 @@ from torchvision import transforms as T
 from torchvision.datasets import ImageFolder
 from PIL import Image
 import torch
+import torch.distributed as dist
+import functools
+import tarfile
+import json
+import io
 import os
 import random
 
@@ -23,7 +28,8 @@ class CelebA(data.Dataset):
         self.idx2attr = {}
         self.preprocess()
 
-        if mode == 'train':
+        # 'eval' reads the training images without augmentation; the test split is too small for FID.
+        if mode in ('train', 'eval'):
             self.num_images = len(self.train_dataset)
         else:
             self.num_images = len(self.test_dataset)
@@ -58,7 +64,7 @@ class CelebA(data.Dataset):
 
     def __getitem__(self, index):
         """Return one image and its corresponding attribute label."""
-        dataset = self.train_dataset if self.mode == 'train' else self.test_dataset
+        dataset = self.train_dataset if self.mode in ('train', 'eval') else self.test_dataset
         filename, label = dataset[index]
         image = Image.open(os.path.join(self.image_dir, filename))
         return self.transform(image), torch.FloatTensor(label)
@@ -68,9 +74,205 @@ class CelebA(data.Dataset):
         return self.num_images
 
 
-def get_loader(image_dir, attr_path, selected_attrs, mode, crop_size=178, image_size=128, 
-               batch_size=16, dataset='CelebA', num_workers=1):
-    """Build and return a data loader."""
+class CelebAShards(data.IterableDataset):
+    """Streaming dataset over CelebA tar shards written by pack_shards."""
+
+    def __init__(self, shard_dir, selected_attrs, transform, mode, shuffle_buffer=1000, seed=0):
+        """Read the shard index and check that it matches the selected attributes."""
+        self.shard_dir = shard_dir
+        self.selected_attrs = selected_attrs
+        self.transform = transform
+        self.mode = mode
+        self.shuffle_buffer = shuffle_buffer if mode == 'train' else 0
+        self.seed = seed
+        self.epoch = 0
+
+        with open(os.path.join(shard_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        if index['selected_attrs'] != list(selected_attrs):
+            raise ValueError('Shards in {} were packed for {}, not {}.'.format(
+                shard_dir, index['selected_attrs'], list(selected_attrs)))
+        split = 'train' if mode in ('train', 'eval') else 'test'
+        self.shards = [os.path.join(shard_dir, name) for name in index[split]['shards']]
+        self.num_images = index[split]['num_images']
+
+    def set_epoch(self, epoch):
+        """Set the epoch used to seed the shard order and the shuffle buffer."""
+        self.epoch = epoch
+
+    def split_info(self):
+        """Return (split_id, num_splits) of this worker across all ranks and loader workers."""
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = 0, 1
+        if worker_info is not None:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def read_shard(self, path):
+        """Yield (filename, jpeg bytes, label) records from one shard in file order."""
+        with tarfile.open(path, 'r|') as tar:
+            image, name = None, None
+            for member in tar:
+                key, ext = os.path.splitext(member.name)
+                payload = tar.extractfile(member).read()
+                if ext == '.jpg':
+                    image, name = payload, key
+                elif ext == '.cls' and key == name:
+                    label = [value == '1' for value in payload.decode('ascii').split()]
+                    yield name, image, label
+
+    def records(self):
+        """Yield the records assigned to this worker, one shard after another."""
+        split_id, num_splits = self.split_info()
+        shards = list(self.shards)
+        if self.mode == 'train':
+            random.Random(self.seed + self.epoch).shuffle(shards)
+
+        if len(shards) >= num_splits:
+            for path in shards[split_id::num_splits]:
+                for record in self.read_shard(path):
+                    yield record
+        else:
+            # Fewer shards than workers: every worker reads all shards and keeps a strided subset.
+            k = 0
+            for path in shards:
+                for record in self.read_shard(path):
+                    if k % num_splits == split_id:
+                        yield record
+                    k += 1
+
+    def __iter__(self):
+        """Stream decoded images and labels, shuffled through an in-memory buffer."""
+        split_id, _ = self.split_info()
+        rng = random.Random(self.seed + self.epoch * 1000003 + split_id)
+
+        buffer = []
+        for record in self.records():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            if self.shuffle_buffer > 0:
+                k = rng.randrange(len(buffer))
+                buffer[k], record = record, buffer[k]
+            yield self.decode(record)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self.decode(record)
+
+    def decode(self, record):
+        """Decode one record into a transformed image and its attribute label."""
+        _, image, label = record
+        image = Image.open(io.BytesIO(image))
+        return self.transform(image), torch.FloatTensor(label)
+
+    def __len__(self):
+        """Return the number of images in the split."""
+        return self.num_images
+
+
+def pack_shards(image_dir, attr_path, selected_attrs, shard_dir, shard_size=1000):
+    """Pack CelebA images and their selected attribute labels into sequential tar shards."""
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    celeba = CelebA(image_dir, attr_path, selected_attrs, None, 'train')
+    index = {'selected_attrs': list(selected_attrs)}
+    for mode, dataset in (('train', celeba.train_dataset), ('test', celeba.test_dataset)):
+        shards = []
+        for start in range(0, len(dataset), shard_size):
+            name = '{}-{:05d}.tar'.format(mode, len(shards))
+            with tarfile.open(os.path.join(shard_dir, name), 'w') as tar:
+                for filename, label in dataset[start:start+shard_size]:
+                    key = os.path.splitext(filename)[0]
+                    tar.add(os.path.join(image_dir, filename), arcname=key + '.jpg')
+                    payload = ' '.join('1' if value else '0' for value in label).encode('ascii')
+                    info = tarfile.TarInfo(key + '.cls')
+                    info.size = len(payload)
+                    tar.addfile(info, io.BytesIO(payload))
+            shards.append(name)
+            print('Packed {} images into {}...'.format(min(start+shard_size, len(dataset)), name))
+        index[mode] = {'shards': shards, 'num_images': len(dataset)}
+
+    with open(os.path.join(shard_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    print('Finished packing the CelebA dataset into {}...'.format(shard_dir))
+
+
+class SharedCelebA(data.Dataset):
+    """Dataset over CelebA images already decoded into (shared-memory) uint8 tensors."""
+
+    def __init__(self, images, labels, mode):
+        """Wrap decoded images (N, 3, H, W) and their attribute labels (N, c_dim)."""
+        self.images = images
+        self.labels = labels
+        self.mode = mode
+        self.num_images = images.size(0)
+
+    def __getitem__(self, index):
+        """Return one normalized image and its corresponding attribute label."""
+        image = self.images[index].float().div(127.5).sub(1)
+        if self.mode == 'train' and random.random() < 0.5:
+            image = image.flip(2)
+        return image, self.labels[index]
+
+    def __len__(self):
+        """Return the number of images."""
+        return self.num_images
+
+
+def decode_dataset(image_dir, attr_path, selected_attrs, crop_size=178, image_size=128):
+    """Decode the CelebA training set once into uint8 image and label tensors in shared memory."""
+    celeba = CelebA(image_dir, attr_path, selected_attrs, None, 'train')
+    transform = T.Compose([T.CenterCrop(crop_size), T.Resize(image_size), T.PILToTensor()])
+    images = torch.empty(celeba.num_images, 3, image_size, image_size, dtype=torch.uint8).share_memory_()
+    labels = torch.FloatTensor([label for _, label in celeba.train_dataset]).share_memory_()
+    for k, (filename, _) in enumerate(celeba.train_dataset):
+        images[k] = transform(Image.open(os.path.join(image_dir, filename)).convert('RGB'))
+    print('Decoded {} CelebA images into shared memory...'.format(celeba.num_images))
+    return images, labels
+
+
+def reserve_worker_cpus(num_workers):
+    """Keep this process off the last num_workers cores and return those cores for the loader workers."""
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) <= num_workers:
+        return None
+    os.sched_setaffinity(0, cpus[:-num_workers])
+    return cpus[-num_workers:]
+
+
+def pin_worker(cpus, worker_id):
+    """Pin a DataLoader worker to its own core."""
+    os.sched_setaffinity(0, [cpus[worker_id % len(cpus)]])
+
+
+def split_process_cpus(ctx, num_procs, num_threads, pin):
+    """Return the thread count per pool process and a queue handing each one its disjoint set of cores.
+
+    num_threads defaults to the available cores divided evenly; without pin, the processes get no cores.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    if num_threads is None:
+        num_threads = max(1, (len(cpus) or os.cpu_count() or 1) // num_procs)
+    cpu_queue = ctx.Queue()
+    for k in range(num_procs):
+        cpu_queue.put(cpus[k*num_threads:(k+1)*num_threads] if pin else [])
+    return num_threads, cpu_queue
+
+
+def pin_process(num_threads, cpu_queue):
+    """Set a pool process's thread count and pin it to the next set of cores from split_process_cpus."""
+    torch.set_num_threads(num_threads)
+    cpus = cpu_queue.get()
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def get_transform(mode, crop_size=178, image_size=128):
+    """Build the image preprocessing transform."""
     transform = []
     if mode == 'train':
         transform.append(T.RandomHorizontalFlip())
@@ -78,20 +280,33 @@ def get_loader(image_dir, attr_path, selected_attrs, mode, crop_size=178, image_
     transform.append(T.Resize(image_size))      #Rahul Ethiraj T.Resize
     transform.append(T.ToTensor())
     transform.append(T.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)))
-    transform = T.Compose(transform)
+    return T.Compose(transform)
+
+
+def get_loader(image_dir, attr_path, selected_attrs, mode, crop_size=178, image_size=128, 
+               batch_size=16, dataset='CelebA', num_workers=1, shard_dir=None, shuffle_buffer=1000,
+               worker_cpus=None):
+    """Build and return a data loader."""
+    transform = get_transform(mode, crop_size, image_size)
+    worker_init_fn = functools.partial(pin_worker, worker_cpus) if worker_cpus else None
+
+    if mode == 'test':
+        batch_size = 1
+
+    if shard_dir:
+        # Shards are shuffled by the dataset itself, so the loader must not shuffle.
+        dataset = CelebAShards(shard_dir, selected_attrs, transform, mode, shuffle_buffer)
+        return data.DataLoader(dataset=dataset,
+                               batch_size=batch_size,
+                               num_workers=num_workers,
+                               worker_init_fn=worker_init_fn)
 
     dataset = CelebA(image_dir, attr_path, selected_attrs, transform, mode)
    
     data_loader = data.DataLoader(dataset=dataset,
                                   batch_size=batch_size,
                                   shuffle=(mode=='train'),
-                                  num_workers=num_workers)
-	
-    if mode == 'test':
-        batch_size = 1
-        data_loader = data.DataLoader(dataset=dataset,
-                                  batch_size=batch_size,
-                                  shuffle=(mode=='train'),
-                                  num_workers=num_workers)
+                                  num_workers=num_workers,
+                                  worker_init_fn=worker_init_fn)
 	
-    return data_loader
\ No newline at end of file
+    return data_loader
@@ -2,7 +2,12 @@ import os
 import argparse
 from solver import Solver
 from data_loader import get_loader
+from data_loader import pack_shards
+from autotune import autotune
+from autotune import apply_cpu_config
+from autotune import load_profile
 from torch.backends import cudnn
+import torch
 
 
 def str2bool(v):
@@ -10,7 +15,8 @@ def str2bool(v):
 
 def main(config):
     # For fast training.
-    cudnn.benchmark = True
+    if torch.cuda.is_available():
+        cudnn.benchmark = True
 
     # Create directories if not exist.
     if not os.path.exists(config.log_dir):
@@ -22,9 +28,44 @@ def main(config):
     if not os.path.exists(config.result_dir):
         os.makedirs(config.result_dir)
 
+    if config.mode == 'pack':
+        if config.shard_dir is None:
+            raise ValueError('--mode pack requires --shard_dir.')
+        pack_shards(config.celeba_image_dir, config.attr_path, config.selected_attrs,
+                    config.shard_dir, config.shard_size)
+        return
+
+    if config.mode == 'autotune':
+        if config.tune_profile is None:
+            raise ValueError('--mode autotune requires --tune_profile.')
+        autotune(config)
+        return
+
+    # Threads, worker pinning and batch size, from a tuning profile if one exists.
+    if config.tune_profile and os.path.exists(config.tune_profile):
+        load_profile(config)
+    worker_cpus = apply_cpu_config(config)
+
+    # An export file holds inference models only: no optimizers, and D may be missing.
+    if config.export_path and config.mode in ['train', 'export']:
+        raise ValueError('--mode {} cannot start from --export_path.'.format(config.mode))
+
+    if config.mode == 'export':
+        solver = Solver(None, config)
+        solver.restore_model(config.test_iters)
+        solver.export_model(config.test_iters)
+        return
+
+    if config.mode == 'video':
+        if config.video_path is None:
+            raise ValueError('--mode video requires --video_path.')
+        solver = Solver(None, config)
+        solver.translate_video()
+        return
+
     celeba_loader = get_loader(config.celeba_image_dir, config.attr_path, config.selected_attrs, config.mode,
                                    config.celeba_crop_size, config.image_size, config.batch_size,
-                                   'CelebA', config.num_workers)
+                                   'CelebA', config.num_workers, config.shard_dir, config.shuffle_buffer, worker_cpus)
     
 
     # Solver for training and testing StarGAN.
@@ -35,10 +76,16 @@ def main(config):
         
     elif config.mode == 'test':
         solver.test()
+
+    elif config.mode == 'eval':
+        solver.load_generator()
+        scores = solver.evaluate()
+        print('Step [{}], FID: {:.4f}, KID: {:.6f}'.format(config.test_iters, scores['eval/FID'], scores['eval/KID']))
         
 
 
-if __name__ == '__main__':
+def get_parser():
+    """Build the command-line parser shared by main.py and sweep.py."""
     parser = argparse.ArgumentParser()
 
     # Model configuration.
@@ -52,9 +99,15 @@ if __name__ == '__main__':
     parser.add_argument('--lambda_cls', type=float, default=1, help='weight for domain classification loss')
     parser.add_argument('--lambda_rec', type=float, default=10, help='weight for reconstruction loss')
     parser.add_argument('--lambda_gp', type=float, default=10, help='weight for gradient penalty')
+    parser.add_argument('--compile', type=str2bool, default=False, help='compile the G and D training forwards with inductor')
+    parser.add_argument('--compile_cache_dir', type=str, default='stargan/compile_cache', help='persistent inductor cache')
+    parser.add_argument('--g_checkpoint', type=str, default='none', choices=['none', 'bottleneck', 'all'],
+                        help='recompute G activations in backward: residual blocks only, or also the down/up-sampling stages')
     
     # Training configuration.
     parser.add_argument('--batch_size', type=int, default=16, help='mini-batch size')
+    parser.add_argument('--micro_batch_size', type=int, default=None,
+                        help='accumulate gradients over micro-batches of this size (default: the whole batch)')
     parser.add_argument('--num_iters', type=int, default=200000, help='number of total iterations for training D')   #Rahul Ethiraj 200000
     parser.add_argument('--num_iters_decay', type=int, default=10000, help='number of iterations for decaying lr')	#Rahul Ethiraj 100000
     parser.add_argument('--g_lr', type=float, default=0.0001, help='learning rate for G')
@@ -63,15 +116,61 @@ if __name__ == '__main__':
     parser.add_argument('--beta1', type=float, default=0.5, help='beta1 for Adam optimizer')
     parser.add_argument('--beta2', type=float, default=0.999, help='beta2 for Adam optimizer')
     parser.add_argument('--resume_iters', type=int, default=None, help='resume training from this step')
+    parser.add_argument('--progressive_sizes', type=int, nargs='+', default=None,
+                        help='training resolutions per stage, ending at --image_size (e.g. 64 128)')
+    parser.add_argument('--progressive_iters', type=int, nargs='+', default=None,
+                        help='iterations at which each stage after the first starts')
     parser.add_argument('--selected_attrs', '--list', nargs='+', help='selected attributes for the CelebA dataset',
                         default=['Male'])			
 
     # Test configuration.
     parser.add_argument('--test_iters', type=int, default=200000, help='test model from this step')		#Rahul Ethiraj 200000
+    parser.add_argument('--export_path', type=str, default=None, help='load inference models from this --mode export file')
+    parser.add_argument('--export_d', type=str2bool, default=True, help='include D in --mode export (test and video need it)')
+
+    # Video configuration.
+    parser.add_argument('--video_path', type=str, default=None, help='local video file to translate in video mode')
+    parser.add_argument('--video_out', type=str, default='stargan/results/video.mp4', help='translated video file')
+    parser.add_argument('--video_crop_size', type=int, default=None, help='center crop size for frames (default: shorter side)')
+    parser.add_argument('--video_batch_size', type=int, default=16, help='number of frames per G forward')
+    parser.add_argument('--video_threshold', type=float, default=0.01,
+                        help='mean abs difference below which a frame reuses the previous output')
+
+    # Translation cache (test and video modes).
+    parser.add_argument('--use_cache', type=str2bool, default=False, help='reuse G outputs for repeated inputs')
+    parser.add_argument('--cache_dir', type=str, default=None, help='directory of the on-disk cache tier')
+    parser.add_argument('--cache_mem_items', type=int, default=1024, help='number of outputs kept in memory')
+    parser.add_argument('--cache_disk_mb', type=int, default=1024, help='size limit of the on-disk cache tier')
+
+    # FID/KID evaluation (every model_save_step in train mode, or --mode eval).
+    parser.add_argument('--eval_fid', type=str2bool, default=False, help='compute FID/KID at every model_save_step')
+    parser.add_argument('--fid_extractor', type=str, default='inception', choices=['inception', 'torchscript'])
+    parser.add_argument('--fid_weights', type=str, default='data/inception_v3_google.pth',
+                        help='torchvision Inception-v3 state dict, or a TorchScript module with --fid_extractor torchscript')
+    parser.add_argument('--fid_cache_dir', type=str, default='stargan/fid', help='directory of cached real-image statistics')
+    parser.add_argument('--fid_num_real', type=int, default=10000, help='number of real images in the cached statistics')
+    parser.add_argument('--fid_num_fake', type=int, default=1000, help='number of generated images per evaluation')
+
+    # CPU auto-tuning (--mode autotune writes --tune_profile, other modes load it if it exists).
+    parser.add_argument('--tune_profile', type=str, default=None, help='JSON profile of threads, workers and batch size')
+    parser.add_argument('--tune_batch_sizes', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--tune_threads', type=int, nargs='+', default=None, help='default: 1, half and all cores')
+    parser.add_argument('--tune_workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--tune_iters', type=int, default=10, help='timed iterations per trial')
+    parser.add_argument('--tune_warmup', type=int, default=3, help='untimed warm-up iterations per trial')
+    parser.add_argument('--tune_memory_mb', type=float, default=None,
+                        help='peak memory budget per configuration (PSS of the trial and its loader workers)')
+
+    # Memory instrumentation (train and test).
+    parser.add_argument('--mem_monitor', type=str2bool, default=False, help='track the peak RSS of each phase and export it every log_step')
+    parser.add_argument('--mem_trace_top', type=int, default=0, help='print the top N tracemalloc diffs every log_step')
+    parser.add_argument('--mem_leak_window', type=int, default=10, help='warn when RSS grows at this many log steps in a row')
 
     # Miscellaneous.
     parser.add_argument('--num_workers', type=int, default=1)
-    parser.add_argument('--mode', type=str, default='train', choices=['train', 'test'])
+    parser.add_argument('--num_threads', type=int, default=None, help='torch intra-op threads (default: torch default)')
+    parser.add_argument('--pin_workers', type=str2bool, default=False, help='pin loader workers to their own cores')
+    parser.add_argument('--mode', type=str, default='train', choices=['train', 'test', 'pack', 'video', 'eval', 'autotune', 'export'])
     parser.add_argument('--use_tensorboard', type=str2bool, default=True)
 
     # Directories.
@@ -81,6 +180,11 @@ if __name__ == '__main__':
     parser.add_argument('--model_save_dir', type=str, default='stargan/models')
     parser.add_argument('--sample_dir', type=str, default='stargan/samples')
     parser.add_argument('--result_dir', type=str, default='stargan/results')
+    parser.add_argument('--shard_dir', type=str, default=None, help='read (or with --mode pack, write) tar shards here')
+
+    # Sharded dataset.
+    parser.add_argument('--shard_size', type=int, default=1000, help='number of images per tar shard')
+    parser.add_argument('--shuffle_buffer', type=int, default=1000, help='size of the in-memory shuffle buffer for shards')
 
     # Step size.
     parser.add_argument('--log_step', type=int, default=10)
@@ -88,6 +192,10 @@ if __name__ == '__main__':
     parser.add_argument('--model_save_step', type=int, default=1000)		#Rahul Ethiraj 10000
     parser.add_argument('--lr_update_step', type=int, default=1000)			#Rahul Ethiraj 1000
 
-    config = parser.parse_args()
+    return parser
+
+
+if __name__ == '__main__':
+    config = get_parser().parse_args()
     print(config)
-    main(config)
\ No newline at end of file
+    main(config)
@@ -0,0 +1,168 @@
+import os
+import resource
+import threading
+import tracemalloc
+import pandas as pd
+import torch
+
+
+def current_rss_mb():
+    """Return the resident set size of this process in MB."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0**20
+    except (IOError, OSError):
+        # No procfs: fall back to the lifetime peak.
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def process_pss_mb(pid):
+    """Return the proportional set size of a process in MB (shared pages split between their users)."""
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    # Kernels without smaps_rollup: fall back to the RSS.
+    with open('/proc/{}/statm'.format(pid), 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0**20
+
+
+def tree_memory_mb(pid=None):
+    """Return the summed PSS of a process and all of its live descendants in MB, from /proc."""
+    pid = pid or os.getpid()
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name), 'r') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # The parent pid is the second field after the parenthesized command name.
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            total += process_pss_mb(p)
+        except (IOError, OSError):
+            pass
+        stack.extend(children.get(p, []))
+    return total
+
+
+class PeakSampler(object):
+    """Polls a memory reading on a background thread and keeps its peak since the last reset."""
+
+    def __init__(self, read=current_rss_mb, interval=0.01):
+        self.read = read
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peak = read()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            value = self.read()
+            with self.lock:
+                self.peak = max(self.peak, value)
+
+    def reset(self):
+        """Return the peak since the last reset and start a new window at the current value."""
+        value = self.read()
+        with self.lock:
+            peak, self.peak = max(self.peak, value), value
+        return peak
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class MemoryMonitor(object):
+    """Tracks peak RSS and torch allocator stats per phase, and flags steady growth between log steps."""
+
+    def __init__(self, enabled=False, csv_path=None, trace_top=0, leak_window=10, leak_mb=1.0, interval=0.005):
+        self.enabled = enabled
+        self.csv_path = csv_path
+        self.trace_top = trace_top
+        self.leak_window = leak_window
+        self.leak_mb = leak_mb
+        self.peaks = {}
+        self.history = []
+        self.snapshot = None
+        self.sampler = None
+        if enabled:
+            # A phase runs from the previous sample() call to its own; its peak RSS is polled in the background.
+            self.sampler = PeakSampler(current_rss_mb, interval)
+            self.max_rss = peak_rss_mb()
+        if enabled and trace_top > 0:
+            tracemalloc.start()
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def sample(self, phase):
+        """Record the peak memory use of the phase that ends now."""
+        if not self.enabled:
+            return
+        rss = self.sampler.reset()
+        # A new lifetime peak reached inside the phase is exact even when it falls between two polls.
+        max_rss = peak_rss_mb()
+        if max_rss > self.max_rss:
+            rss = max(rss, max_rss)
+            self.max_rss = max_rss
+        self.peaks[phase] = max(self.peaks.get(phase, 0), rss)
+        if torch.cuda.is_available():
+            allocated = torch.cuda.max_memory_allocated() / 2.0**20
+            self.peaks[phase + '/cuda'] = max(self.peaks.get(phase + '/cuda', 0), allocated)
+            torch.cuda.reset_peak_memory_stats()
+
+    def stats(self):
+        """Return the current, peak and per-phase peak memory in MB."""
+        rss = current_rss_mb()
+        stats = {'mem/rss_mb': rss, 'mem/peak_rss_mb': max(rss, peak_rss_mb())}
+        if torch.cuda.is_available():
+            stats['mem/cuda_allocated_mb'] = torch.cuda.memory_allocated() / 2.0**20
+        for phase, value in self.peaks.items():
+            stats['mem/peak_{}_mb'.format(phase)] = value
+        return stats
+
+    def log(self, step):
+        """Export the stats of this log step, check for growth and print tracemalloc diffs; return the stats."""
+        if not self.enabled:
+            return {}
+        stats = self.stats()
+        if self.csv_path is not None:
+            # One row per metric, since new phases can appear between log steps.
+            df = pd.DataFrame({'step': step, 'metric': list(stats.keys()), 'value': list(stats.values())})
+            df.to_csv(self.csv_path, mode='a', header=not os.path.exists(self.csv_path), index=False)
+
+        # Flag RSS that grew at every one of the last leak_window log steps.
+        self.history = (self.history + [stats['mem/rss_mb']])[-(self.leak_window + 1):]
+        growth = self.history[-1] - self.history[0]
+        if (len(self.history) > self.leak_window and growth > self.leak_mb
+                and all(b > a for a, b in zip(self.history, self.history[1:]))):
+            print('Warning: RSS grew at each of the last {} log steps (+{:.1f} MB), possible leak.'.format(
+                self.leak_window, growth))
+
+        if self.snapshot is not None:
+            snapshot = tracemalloc.take_snapshot()
+            print('Top {} allocation diffs since the last log step:'.format(self.trace_top))
+            for stat in snapshot.compare_to(self.snapshot, 'lineno')[:self.trace_top]:
+                print('  {}'.format(stat))
+            self.snapshot = snapshot
+        return stats
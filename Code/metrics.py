@@ -0,0 +1,168 @@
+import os
+import random
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from cache import file_digest
+
+
+class InceptionFeatures(nn.Module):
+    """Torchvision Inception-v3 pool features (2048-d) for images in [-1, 1], with weights from a local file."""
+
+    def __init__(self, weights_path):
+        super(InceptionFeatures, self).__init__()
+        from torchvision.models import inception_v3
+        self.net = inception_v3(weights=None, aux_logits=False, init_weights=False)
+        state_dict = torch.load(weights_path, map_location=lambda storage, loc: storage)
+        # The 1008-class FID Inception weights expect pytorch-fid's modified blocks and input scaling; loaded
+        # here they would give scores that are not comparable to the reference FID.
+        if state_dict['fc.weight'].size(0) != 1000:
+            raise ValueError('{} is not a torchvision Inception-v3 state dict ({} classes); run FID Inception '
+                             'weights as a TorchScript module with --fid_extractor torchscript.'.format(
+                                 weights_path, state_dict['fc.weight'].size(0)))
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith('AuxLogits.')}
+        self.net.load_state_dict(state_dict)
+        self.net.fc = nn.Identity()
+        self.net.eval()
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+
+    def forward(self, x):
+        x = F.interpolate((x + 1) / 2, size=(299, 299), mode='bilinear', align_corners=False)
+        return self.net((x - self.mean) / self.std)
+
+
+def build_extractor(name, weights_path):
+    """Build a feature extractor: 'inception' (torchvision state dict) or 'torchscript' (any scripted module)."""
+    if name == 'inception':
+        return InceptionFeatures(weights_path)
+    if name == 'torchscript':
+        return torch.jit.load(weights_path, map_location='cpu').eval()
+    raise ValueError('Unknown feature extractor {}.'.format(name))
+
+
+class FeatureStats(object):
+    """Running mean and covariance of features, plus a bounded random sample of them for KID."""
+
+    def __init__(self, sample_size=1000):
+        self.n = 0
+        self.sum = None
+        self.sum_outer = None
+        self.sample_size = sample_size
+        self.sample = []
+
+    def update(self, features):
+        """Add a batch of (N, D) features."""
+        features = features.detach().cpu().double().numpy()
+        if self.sum is None:
+            self.sum = np.zeros(features.shape[1])
+            self.sum_outer = np.zeros((features.shape[1], features.shape[1]))
+        self.sum += features.sum(axis=0)
+        self.sum_outer += features.T.dot(features)
+        for row in features:
+            # Reservoir sampling keeps a uniform sample without holding every feature.
+            self.n += 1
+            if len(self.sample) < self.sample_size:
+                self.sample.append(row)
+            else:
+                k = random.randrange(self.n)
+                if k < self.sample_size:
+                    self.sample[k] = row
+
+    def mean_cov(self):
+        """Return the feature mean and the unbiased covariance."""
+        mu = self.sum / self.n
+        sigma = (self.sum_outer - self.n * np.outer(mu, mu)) / (self.n - 1)
+        return mu, sigma
+
+    def save(self, path):
+        np.savez(path, n=self.n, sum=self.sum, sum_outer=self.sum_outer, sample=np.array(self.sample))
+
+    @classmethod
+    def load(cls, path):
+        stats = np.load(path)
+        out = cls(len(stats['sample']))
+        out.n = int(stats['n'])
+        out.sum = stats['sum']
+        out.sum_outer = stats['sum_outer']
+        out.sample = list(stats['sample'])
+        return out
+
+
+def frechet_distance(real, fake):
+    """FID between two FeatureStats: |mu1 - mu2|^2 + Tr(S1 + S2 - 2 (S1 S2)^1/2)."""
+    mu1, sigma1 = real.mean_cov()
+    mu2, sigma2 = fake.mean_cov()
+    # Tr((S1 S2)^1/2) equals the sum of square roots of the eigenvalues of S1^1/2 S2 S1^1/2.
+    w, v = np.linalg.eigh(sigma1)
+    sqrt_sigma1 = (v * np.sqrt(np.clip(w, 0, None))).dot(v.T)
+    eigvals = np.linalg.eigvalsh(sqrt_sigma1.dot(sigma2).dot(sqrt_sigma1))
+    tr_covmean = np.sqrt(np.clip(eigvals, 0, None)).sum()
+    return float(np.sum((mu1 - mu2) ** 2) + np.trace(sigma1) + np.trace(sigma2) - 2 * tr_covmean)
+
+
+def kernel_inception_distance(real, fake, num_subsets=10, subset_size=1000):
+    """Unbiased polynomial-kernel MMD^2 between the feature samples, averaged over random subsets."""
+    x, y = np.array(real.sample), np.array(fake.sample)
+    m = min(len(x), len(y), subset_size)
+    d = x.shape[1]
+    mmd = 0
+    for _ in range(num_subsets):
+        a = x[np.random.choice(len(x), m, replace=False)]
+        b = y[np.random.choice(len(y), m, replace=False)]
+        k_aa = (a.dot(a.T) / d + 1) ** 3
+        k_bb = (b.dot(b.T) / d + 1) ** 3
+        k_ab = (a.dot(b.T) / d + 1) ** 3
+        mmd += ((k_aa.sum() - np.trace(k_aa) + k_bb.sum() - np.trace(k_bb)) / (m * (m - 1))
+                - 2 * k_ab.mean())
+    return float(mmd / num_subsets)
+
+
+class Evaluator(object):
+    """Computes FID/KID of generated images against cached real-image feature statistics."""
+
+    def __init__(self, extractor, weights_path, cache_dir, device, sample_size=1000):
+        self.extractor = build_extractor(extractor, weights_path).to(device)
+        # Keyed by content, so replacing the weights file under the same name does not reuse stale statistics.
+        self.extractor_id = '{}-{}'.format(extractor, file_digest(weights_path)[:16])
+        self.cache_dir = cache_dir
+        self.device = device
+        self.sample_size = sample_size
+        self.real = None
+
+    def features(self, x):
+        with torch.no_grad():
+            return self.extractor(x.to(self.device))
+
+    def real_stats(self, data_loader, data_id, split, image_size, num_images):
+        """Return the real-image statistics of a split, computing and caching them on first use.
+
+        data_id names the real images (dataset, source and preprocessing); it is part of the cache key.
+        """
+        if self.real is not None:
+            return self.real
+        path = os.path.join(self.cache_dir, '{}-{}-{}px-{}-{}.npz'.format(
+            data_id, split, image_size, num_images, self.extractor_id))
+        if os.path.exists(path):
+            print('Loading cached real-image statistics from {}...'.format(path))
+            self.real = FeatureStats.load(path)
+            return self.real
+
+        self.real = FeatureStats(self.sample_size)
+        for x_real, _ in data_loader:
+            self.real.update(self.features(x_real))
+            if self.real.n >= num_images:
+                break
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.real.save(path)
+        print('Saved real-image statistics of {} images into {}...'.format(self.real.n, path))
+        return self.real
+
+    def score(self, fake_batches):
+        """Stream generated batches into fresh statistics and return (FID, KID)."""
+        fake = FeatureStats(self.sample_size)
+        for x_fake in fake_batches:
+            fake.update(self.features(x_fake))
+        return frechet_distance(self.real, fake), kernel_inception_distance(self.real, fake)
@@ -1,9 +1,29 @@
+import contextlib
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
 
+@contextlib.contextmanager
+def restore_buffers(module):
+    """Undo any update made to the buffers (e.g. norm running stats) of module inside the block."""
+    saved = [b.clone() for b in module.buffers()]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for b, value in zip(module.buffers(), saved):
+                b.copy_(value)
+
+
+def recompute_contexts(module):
+    """Checkpoint context_fn: run the forward as is and restore module's buffers after the recompute."""
+    return contextlib.nullcontext(), restore_buffers(module)
+
+
 class ResidualBlock(nn.Module):
     """Residual Block with instance normalization."""
     def __init__(self, dim_in, dim_out):
@@ -21,8 +41,9 @@ class ResidualBlock(nn.Module):
 
 class Generator(nn.Module):
     """Generator network."""
-    def __init__(self, conv_dim=64, c_dim=5, repeat_num=6):
+    def __init__(self, conv_dim=64, c_dim=5, repeat_num=6, checkpoint='none'):
         super(Generator, self).__init__()
+        self.checkpoint = checkpoint
 
         layers = []
         layers.append(nn.Conv2d(3+c_dim, conv_dim, kernel_size=7, stride=1, padding=3, bias=False))
@@ -52,12 +73,36 @@ class Generator(nn.Module):
         layers.append(nn.Tanh())
         self.main = nn.Sequential(*layers)
 
+        # Segments of self.main as (start, end, checkpointed). The stem and down-sampling stage
+        # end at layer 9, followed by one segment per residual block and the up-sampling stage.
+        down, up = 9, 9 + repeat_num
+        stages = checkpoint == 'all'
+        blocks = checkpoint in ('bottleneck', 'all')
+        self.segments = [(0, down, stages)]
+        self.segments += [(k, k+1, blocks) for k in range(down, up)]
+        self.segments += [(up, up+6, stages), (up+6, len(layers), False)]
+
     def forward(self, x, c):
         # Replicate spatially and concatenate domain information.
         c = c.view(c.size(0), c.size(1), 1, 1)
         c = c.repeat(1, 1, x.size(2), x.size(3))
         x = torch.cat([x, c], dim=1)
-        return self.main(x)
+        if self.checkpoint == 'none' or not (self.training and torch.is_grad_enabled()):
+            return self.main(x)
+
+        # Recompute the activations of checkpointed segments during backward instead of storing them.
+        # Eager recomputation would update the InstanceNorm running stats a second time, so restore them.
+        # Compiled graphs apply buffer updates once in the forward and only recompute activations.
+        for start, end, checkpointed in self.segments:
+            segment = self.main[start:end]
+            if checkpointed and torch.compiler.is_compiling():
+                x = checkpoint(segment, x, use_reentrant=False)
+            elif checkpointed:
+                x = checkpoint(segment, x, use_reentrant=False,
+                               context_fn=functools.partial(recompute_contexts, segment))
+            else:
+                x = segment(x)
+        return x
 
 
 class Discriminator(nn.Module):
@@ -75,6 +120,7 @@ class Discriminator(nn.Module):
             curr_dim = curr_dim * 2
 
         kernel_size = int(image_size / np.power(2, repeat_num))
+        self.kernel_size = kernel_size
         self.main = nn.Sequential(*layers)
         self.conv1 = nn.Conv2d(curr_dim, 1, kernel_size=3, stride=1, padding=1, bias=False)
         self.conv2 = nn.Conv2d(curr_dim, c_dim, kernel_size=kernel_size, bias=False)
@@ -83,5 +129,8 @@ class Discriminator(nn.Module):
         #print('=======FORWARD')
         h = self.main(x)
         out_src = self.conv1(h)
+        if h.size(2) != self.kernel_size or h.size(3) != self.kernel_size:
+            # Lower-resolution input (progressive training): pool the features to the head's size.
+            h = F.adaptive_avg_pool2d(h, self.kernel_size)
         out_cls = self.conv2(h)
         return out_src, out_cls.view(out_cls.size(0), out_cls.size(1))
\ No newline at end of file
@@ -1,5 +1,9 @@
 from model import Generator
 from model import Discriminator
+from cache import TranslationCache
+from cache import file_digest
+from metrics import Evaluator
+from memory import MemoryMonitor
 from torch.autograd import Variable
 from torchvision.utils import save_image
 import torch
@@ -8,6 +12,8 @@ import numpy as np
 import os
 import time
 import datetime
+import hashlib
+import json
 import pandas as pd
 #import matplotlib.pyplot as plt
 import seaborn as sns
@@ -32,10 +38,16 @@ class Solver(object):
         self.lambda_cls = config.lambda_cls
         self.lambda_rec = config.lambda_rec
         self.lambda_gp = config.lambda_gp
+        self.g_checkpoint = config.g_checkpoint
+        self.compile = config.compile
+        self.compile_cache_dir = config.compile_cache_dir
 
         # Training configurations.
         self.dataset = 'CelebA'
         self.batch_size = config.batch_size
+        self.micro_batch_size = config.micro_batch_size
+        if self.micro_batch_size is not None and self.micro_batch_size <= 0:
+            raise ValueError('--micro_batch_size must be positive.')
         self.num_iters = config.num_iters
         self.num_iters_decay = config.num_iters_decay
         self.g_lr = config.g_lr
@@ -45,9 +57,41 @@ class Solver(object):
         self.beta2 = config.beta2
         self.resume_iters = config.resume_iters
         self.selected_attrs = config.selected_attrs
+        self.progressive_sizes = config.progressive_sizes or [self.image_size]
+        self.progressive_iters = config.progressive_iters or []
+        self.check_progressive()
 
         # Test configurations.
         self.test_iters = config.test_iters
+        self.export_path = config.export_path
+        self.export_d = config.export_d
+
+        # Video configurations.
+        self.video_path = config.video_path
+        self.video_out = config.video_out
+        self.video_crop_size = config.video_crop_size
+        self.video_batch_size = config.video_batch_size
+        self.video_threshold = config.video_threshold
+
+        # Cache configurations.
+        self.use_cache = config.use_cache
+        self.cache_dir = config.cache_dir
+        self.cache_mem_items = config.cache_mem_items
+        self.cache_disk_mb = config.cache_disk_mb
+        self.cache = None
+
+        # Evaluation configurations.
+        self.eval_fid = config.eval_fid
+        self.fid_extractor = config.fid_extractor
+        self.fid_weights = config.fid_weights
+        self.fid_cache_dir = config.fid_cache_dir
+        self.fid_num_real = config.fid_num_real
+        self.fid_num_fake = config.fid_num_fake
+        self.celeba_image_dir = config.celeba_image_dir
+        self.attr_path = config.attr_path
+        self.celeba_crop_size = config.celeba_crop_size
+        self.shard_dir = config.shard_dir
+        self.evaluator = None
 
         # Miscellaneous.
         self.use_tensorboard = config.use_tensorboard
@@ -65,14 +109,21 @@ class Solver(object):
         self.model_save_step = config.model_save_step
         self.lr_update_step = config.lr_update_step
 
+        # Memory instrumentation.
+        self.mem = MemoryMonitor(config.mem_monitor, os.path.join(self.log_dir, 'memory.csv'),
+                                 config.mem_trace_top, config.mem_leak_window)
+
         # Build the model and tensorboard.
-        self.build_model()
+        if self.export_path:
+            self.load_export(self.export_path)
+        else:
+            self.build_model()
         if self.use_tensorboard:
             self.build_tensorboard()
 
     def build_model(self):
         """Create a generator and a discriminator."""
-        self.G = Generator(self.g_conv_dim, self.c_dim, self.g_repeat_num)
+        self.G = Generator(self.g_conv_dim, self.c_dim, self.g_repeat_num, self.g_checkpoint)
         self.D = Discriminator(self.image_size, self.d_conv_dim, self.c_dim, self.d_repeat_num) 
         
         self.g_optimizer = torch.optim.Adam(self.G.parameters(), self.g_lr, [self.beta1, self.beta2])
@@ -83,6 +134,24 @@ class Solver(object):
         self.G.to(self.device)
         self.D.to(self.device)
 
+        # Training forwards, compiled with inductor when requested. They share parameters with G and D.
+        self.G_train = self.G
+        self.D_train = self.D
+        if self.compile:
+            self.compile_model()
+
+    def compile_model(self):
+        """Compile the training forwards of G and D, caching the generated code across runs."""
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(self.compile_cache_dir))
+        import torch._dynamo
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
+        # Run a forward eagerly instead of failing when it cannot be compiled. The fallback is only logged
+        # ("WON'T CONVERT ..."), so a forward dynamo cannot trace silently loses the speedup.
+        torch._dynamo.config.suppress_errors = True
+        self.G_train = torch.compile(self.G, backend='inductor')
+        self.D_train = torch.compile(self.D, backend='inductor')
+
     def print_network(self, model, name):
         """Print out the network information."""
         num_params = 0
@@ -100,6 +169,114 @@ class Solver(object):
         self.G.load_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage))
         self.D.load_state_dict(torch.load(D_path, map_location=lambda storage, loc: storage))
 
+        stage_path = os.path.join(self.model_save_dir, '{}-stage.json'.format(resume_iters))
+        if os.path.exists(stage_path):
+            with open(stage_path, 'r') as f:
+                saved = json.load(f)
+            print('Checkpoint was saved at progressive stage {} ({}px)...'.format(saved['stage'], saved['image_size']))
+
+    def export_model(self, iters):
+        """Export G (and optionally D) with the model hyperparameters into one memory-mappable file."""
+        export = {'config': {'c_dim': self.c_dim, 'image_size': self.image_size,
+                             'g_conv_dim': self.g_conv_dim, 'g_repeat_num': self.g_repeat_num,
+                             'd_conv_dim': self.d_conv_dim, 'd_repeat_num': self.d_repeat_num,
+                             'selected_attrs': self.selected_attrs, 'iters': iters},
+                  'G': self.G.state_dict()}
+        if self.export_d:
+            export['D'] = self.D.state_dict()
+        export_path = os.path.join(self.model_save_dir, '{}-export.pt'.format(iters))
+        torch.save(export, export_path)
+        print('Exported the trained models into {}...'.format(export_path))
+
+    def load_export(self, export_path):
+        """Build G (and D, if exported) for inference with weights memory-mapped from an export file."""
+        # Tensors stay backed by the file's pages, which the OS shares between processes loading it.
+        export = torch.load(export_path, map_location='cpu', mmap=True, weights_only=True)
+        for name, value in export['config'].items():
+            if name != 'iters':
+                setattr(self, name, value)
+        print('Loading the exported models of step {} from {}...'.format(export['config']['iters'], export_path))
+
+        # Build on the meta device so no weights are allocated before they are assigned.
+        with torch.device('meta'):
+            self.G = Generator(self.g_conv_dim, self.c_dim, self.g_repeat_num)
+            self.D = Discriminator(self.image_size, self.d_conv_dim, self.c_dim, self.d_repeat_num) if 'D' in export else None
+        self.G.load_state_dict(export['G'], assign=True)
+        self.G.to(self.device)
+        if self.D is not None:
+            self.D.load_state_dict(export['D'], assign=True)
+            self.D.to(self.device)
+
+    def check_discriminator(self, purpose):
+        """Raise a clear error when D is needed but the export file does not include it."""
+        if self.D is None:
+            raise ValueError('{} needs D, but {} was exported with --export_d false.'.format(purpose, self.export_path))
+
+    def load_generator(self):
+        """Load the trained models for inference from the export file or the test_iters checkpoints."""
+        if self.export_path:
+            model_path = self.export_path
+        else:
+            self.restore_model(self.test_iters)
+            model_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(self.test_iters))
+        if self.use_cache:
+            self.build_cache(model_path)
+
+    def build_cache(self, model_path):
+        """Build the translation cache for the given generator checkpoint file."""
+        self.cache = TranslationCache(file_digest(model_path), self.cache_mem_items,
+                                      self.cache_dir, self.cache_disk_mb * 2**20)
+
+    def print_cache_stats(self):
+        """Print the hit-rate metrics of the translation cache."""
+        if self.cache is None:
+            return
+        log = 'Translation cache'
+        for tag, value in self.cache.stats().items():
+            log += ", {}: {:.4f}".format(tag, value) if isinstance(value, float) else ", {}: {}".format(tag, value)
+        print(log)
+
+    def generate(self, x, c_trg):
+        """Run G, sending only the cache misses through it when a translation cache is built."""
+        if self.cache is None:
+            return self.G(x, c_trg)
+
+        keys = [self.cache.key(x[k], c_trg[k]) for k in range(x.size(0))]
+        outputs = [self.cache.get(key) for key in keys]
+        misses = [k for k, out in enumerate(outputs) if out is None]
+        if misses:
+            x_fake = self.G(x[misses], c_trg[misses])
+            for k, out in zip(misses, x_fake):
+                self.cache.put(keys[k], out)
+                outputs[k] = out
+        return torch.stack([out.to(self.device) for out in outputs])
+
+    def check_progressive(self):
+        """Validate the progressive-resolution schedule against the model configuration."""
+        if len(self.progressive_iters) != len(self.progressive_sizes) - 1:
+            raise ValueError('--progressive_iters needs one boundary per stage after the first.')
+        if self.progressive_iters != sorted(self.progressive_iters):
+            raise ValueError('--progressive_iters must be increasing.')
+        if self.progressive_sizes[-1] != self.image_size:
+            raise ValueError('The last progressive size must equal --image_size.')
+        for size in self.progressive_sizes:
+            if size < 2 ** self.d_repeat_num:
+                raise ValueError('Stage size {} is too small for a D with {} strided convs.'.format(
+                    size, self.d_repeat_num))
+
+    def progressive_stage(self, iters):
+        """Return the (stage index, image size) used at the given iteration."""
+        stage = 0
+        while stage < len(self.progressive_iters) and iters >= self.progressive_iters[stage]:
+            stage += 1
+        return stage, self.progressive_sizes[stage]
+
+    def resize(self, x, size):
+        """Downsample a batch of images to the current stage resolution."""
+        if x.size(2) == size and x.size(3) == size:
+            return x
+        return F.interpolate(x, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+
     def build_tensorboard(self):
         """Build a tensorboard logger."""
         from logger import Logger
@@ -137,55 +314,41 @@ class Solver(object):
         return torch.mean((dydx_l2norm-1)**2)
 
     
-    def create_labels(self, c_org, c_dim=5, dataset='CelebA', selected_attrs=None, mode='train'):
-        """Generate target domain labels for debugging and testing."""
-        c_trg_list = []
-        data_loader = self.celeba_loader
-        c_trg = c_org.clone()
-        '''
-        data_iter = iter(data_loader)
-        x_fixed, c_org = next(data_iter)
-		
-		# Fetch real images and labels.
-        try:
-            x_real, label_org = next(data_iter)
-                #print(type(x_real),x_real.size())         # <class 'torch.Tensor'> torch.Size([16, 3, 128, 128])
-                #print(type(label_org),label_org.size())   # <class 'torch.Tensor'> torch.Size([16, 1]) 
-        except:
-            data_iter = iter(data_loader)
-            x_real, label_org = next(data_iter)
-		
-        x_real = x_real.to(self.device)
-        '''
-        
-        if mode=='test':
-            for i, (x_real, c_org) in enumerate(data_loader):    
-                #print(x_real.size(),x_real)
-                #print(c_org.size(),c_org)
-               
-                
-				# Prepare input images and target domain labels.
-                x_real = x_real.to(self.device)
-                #c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
-                out_src, out_cls = self.D(x_real)
-                if out_cls>0:
-                    c_trg[:, 0]=0
-                else:
-                    c_trg[:, 0]=1
-                #print('Out_cls : ',out_cls,' i= ',i+1)
-                c_trg_list.append(c_trg.to(self.device))     
-            return c_trg_list
-        
-        c_trg_list = []
-        i=0
-        c_trg = c_org.clone()
-        c_trg[:, i] = (c_trg[:, i] == 0)  # Reverse attribute value.
-        c_trg_list.append(c_trg.to(self.device))
-        #print('c_org',c_org)												Reverses the original labels, for Male
-        #print('c_trg_list',c_trg_list)
-		
-        return c_trg_list
+    def fanout_labels(self, c_org):
+        """Stack the target labels of every domain into one (c_dim*B, c_dim) tensor, domain-major."""
+        batch_size, c_dim = c_org.size(0), c_org.size(1)
+        c_trg = c_org.repeat(c_dim, 1)
+        rows = torch.arange(c_dim * batch_size, device=c_org.device)
+        cols = torch.arange(c_dim, device=c_org.device).repeat_interleave(batch_size)
+        c_trg[rows, cols] = 1 - c_trg[rows, cols]  # Reverse attribute value.
+        return c_trg
+
+    def flip_detected(self, x):
+        """Return target labels with the first attribute D detects in x flipped and the others kept."""
+        _, out_cls = self.D(x)
+        c_trg = (out_cls > 0).float()
+        c_trg[:, 0] = 1 - c_trg[:, 0]
+        return c_trg
+
+    def translate_fanout(self, x, c_org):
+        """Translate x into every target domain with one batched G forward; returns (c_dim, B, 3, H, W)."""
+        c_dim = c_org.size(1)
+        c_trg = self.fanout_labels(c_org).to(self.device)
+        x_fake = self.generate(x.repeat(c_dim, 1, 1, 1), c_trg)
+        return x_fake.view(c_dim, x.size(0), x.size(1), x.size(2), x.size(3))
+
+    def sample_grid(self, x_real, x_fakes):
+        """Lay out each real image followed by its translations along the width."""
+        x_all = torch.cat([x_real.unsqueeze(0), x_fakes], dim=0)
+        k, b, c, h, w = x_all.size()
+        return x_all.permute(1, 2, 3, 0, 4).reshape(b, c, h, k * w)
 	
+    def micro_batches(self, batch):
+        """Split a tuple of batch tensors into tuples of at most micro_batch_size rows."""
+        size = self.micro_batch_size or batch[0].size(0)
+        for start in range(0, batch[0].size(0), size):
+            yield tuple(t[start:start+size] for t in batch)
+
     def classification_loss(self, logit, target, dataset='CelebA'):
         """Compute binary or softmax cross entropy loss."""
         return F.binary_cross_entropy_with_logits(logit, target, size_average=False) / logit.size(0)
@@ -199,7 +362,7 @@ class Solver(object):
         data_iter = iter(data_loader)
         x_fixed, c_org = next(data_iter)
         x_fixed = x_fixed.to(self.device)
-        c_fixed_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
+        c_fixed = c_org.to(self.device)
 
         # Learning rate cache for decaying.
         g_lr = self.g_lr
@@ -214,6 +377,9 @@ class Solver(object):
         # Start training.
         print('Start training...')
         start_time = time.time()
+        epoch = 0
+        self.last_loss = {}
+        stage, stage_size = self.progressive_stage(start_iters)
 		
         D1=[]
         D2=[]
@@ -236,6 +402,9 @@ class Solver(object):
                 #print(type(x_real),x_real.size())         # <class 'torch.Tensor'> torch.Size([16, 3, 128, 128])
                 #print(type(label_org),label_org.size())   # <class 'torch.Tensor'> torch.Size([16, 1]) 
             except:
+                epoch += 1
+                if hasattr(data_loader.dataset, 'set_epoch'):
+                    data_loader.dataset.set_epoch(epoch)
                 data_iter = iter(data_loader)
                 x_real, label_org = next(data_iter)
 
@@ -244,6 +413,13 @@ class Solver(object):
             #rand_idx = torch.randperm(label_org.size(0))
             #label_trg = label_org[rand_idx]
 			
+            # Switch to the next resolution at the progressive-schedule boundaries.
+            if self.progressive_stage(i)[0] != stage:
+                stage, stage_size = self.progressive_stage(i)
+                print('Progressive training: switched to stage {} ({}px)...'.format(stage, stage_size))
+            x_real = self.resize(x_real, stage_size)
+            self.mem.sample('data')
+
             label_trg = label_org.clone()
             label_trg[:, 0] = (label_org[:, 0] == 0)
 			
@@ -261,41 +437,49 @@ class Solver(object):
             #                             2. Train the discriminator                              #
             # =================================================================================== #
 
-            # Compute loss with real images.
-            out_src, out_cls = self.D(x_real)
-            #print(type(out_src),out_src.size())    #<class 'torch.Tensor'> torch.Size([16, 1, 2, 2])
-            #print(type(out_cls),out_cls.size())    # <class 'torch.Tensor'> torch.Size([16, 1])
+            # Split the batch into micro-batches to bound activation memory. Every loss is a mean over
+            # the batch, so weighting each micro-batch by its share gives the full-batch gradients.
+            batch = (x_real, c_org, c_trg, label_org, label_trg)
+            loss = {'D/loss_real': 0, 'D/loss_fake': 0, 'D/loss_cls': 0, 'D/loss_gp': 0}
+            self.reset_grad()
+            for x_real, c_org, c_trg, label_org, label_trg in self.micro_batches(batch):
+                weight = x_real.size(0) / float(batch[0].size(0))
+
+                # Compute loss with real images.
+                out_src, out_cls = self.D_train(x_real)
+                #print(type(out_src),out_src.size())    #<class 'torch.Tensor'> torch.Size([16, 1, 2, 2])
+                #print(type(out_cls),out_cls.size())    # <class 'torch.Tensor'> torch.Size([16, 1])
 			
 			
-            d_loss_real = - torch.mean(out_src)
-            d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
-
-            # Compute loss with fake images.
-            x_fake = self.G(x_real, c_trg)
-            out_src, out_cls = self.D(x_fake.detach())
-            d_loss_fake = torch.mean(xxxxxxxxxxx)    			# pRINT THIS AND CHECK
-
-            # Compute loss for gradient penalty.
-            alpha = torch.rand(x_real.size(0), 1, 1, 1).to(self.device)
-            x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
-            out_src, _ = self.D(x_hat)
-            #print('out_src,out_src.size()0',out_src,out_src.size())
-            #print('x_hat,x_hat.size()',x_hat,x_hat.size())
-            d_loss_gp = self.gradient_penalty(out_src, x_hat)
-            #print('d_loss_gp' ,d_loss_gp)
+                d_loss_real = - torch.mean(out_src)
+                d_loss_cls = self.classification_loss(out_cls, label_org, self.dataset)
+
+                # Compute loss with fake images.
+                x_fake = self.G_train(x_real, c_trg)
+                out_src, out_cls = self.D_train(x_fake.detach())
+                d_loss_fake = torch.mean(out_src)
+
+                # Compute loss for gradient penalty.
+                alpha = torch.rand(x_real.size(0), 1, 1, 1).to(self.device)
+                x_hat = (alpha * x_real.data + (1 - alpha) * x_fake.data).requires_grad_(True)
+                out_src, _ = self.D(x_hat)  # Eager: compiled graphs do not support the double backward.
+                #print('out_src,out_src.size()0',out_src,out_src.size())
+                #print('x_hat,x_hat.size()',x_hat,x_hat.size())
+                d_loss_gp = self.gradient_penalty(out_src, x_hat)
+                #print('d_loss_gp' ,d_loss_gp)
 			
-            # Backward and optimize.
-            d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + self.lambda_gp * d_loss_gp
-            self.reset_grad()
-            d_loss.backward()
-            self.d_optimizer.step()
+                # Backward, accumulating weighted gradients across micro-batches.
+                d_loss = d_loss_real + d_loss_fake + self.lambda_cls * d_loss_cls + self.lambda_gp * d_loss_gp
+                (weight * d_loss).backward()
+
+                # Logging.
+                loss['D/loss_real'] += weight * d_loss_real.item()
+                loss['D/loss_fake'] += weight * d_loss_fake.item()
+                loss['D/loss_cls'] += weight * d_loss_cls.item()
+                loss['D/loss_gp'] += weight * d_loss_gp.item()
 
-            # Logging.
-            loss = {}
-            loss['D/loss_real'] = d_loss_real.item()
-            loss['D/loss_fake'] = d_loss_fake.item()
-            loss['D/loss_cls'] = d_loss_cls.item()
-            loss['D/loss_gp'] = d_loss_gp.item()
+            self.d_optimizer.step()
+            self.mem.sample('D')
 			
             #print('D1: ',D1)
             #print('size',len(D1))
@@ -310,26 +494,32 @@ class Solver(object):
             # =================================================================================== #
             
             if (i+1) % self.n_critic == 0:
-                # Original-to-target domain.
-                x_fake = self.G(x_real, c_trg)
-                out_src, out_cls = self.D(x_fake)
-                g_loss_fake = - torch.mean(out_src)
-                g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
-
-                # Target-to-original domain.
-                x_reconst = self.G(x_fake, c_org)
-                g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
-
-                # Backward and optimize.
-                g_loss = g_loss_fake + self.lambda_rec * g_loss_rec + self.lambda_cls * g_loss_cls
+                loss.update({'G/loss_fake': 0, 'G/loss_rec': 0, 'G/loss_cls': 0})
                 self.reset_grad()
-                g_loss.backward()
-                self.g_optimizer.step()
+                for x_real, c_org, c_trg, label_org, label_trg in self.micro_batches(batch):
+                    weight = x_real.size(0) / float(batch[0].size(0))
 
-                # Logging.
-                loss['G/loss_fake'] = g_loss_fake.item()
-                loss['G/loss_rec'] = g_loss_rec.item()
-                loss['G/loss_cls'] = g_loss_cls.item()
+                    # Original-to-target domain.
+                    x_fake = self.G_train(x_real, c_trg)
+                    out_src, out_cls = self.D_train(x_fake)
+                    g_loss_fake = - torch.mean(out_src)
+                    g_loss_cls = self.classification_loss(out_cls, label_trg, self.dataset)
+
+                    # Target-to-original domain.
+                    x_reconst = self.G_train(x_fake, c_org)
+                    g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
+
+                    # Backward, accumulating weighted gradients across micro-batches.
+                    g_loss = g_loss_fake + self.lambda_rec * g_loss_rec + self.lambda_cls * g_loss_cls
+                    (weight * g_loss).backward()
+
+                    # Logging.
+                    loss['G/loss_fake'] += weight * g_loss_fake.item()
+                    loss['G/loss_rec'] += weight * g_loss_rec.item()
+                    loss['G/loss_cls'] += weight * g_loss_cls.item()
+
+                self.g_optimizer.step()
+                self.mem.sample('G')
 				
                 #print('G/LOSS : ',g_loss_rec.item())
                 #G1.append(g_loss_fake)
@@ -340,6 +530,9 @@ class Solver(object):
             #                                 4. Miscellaneous                                    #
             # =================================================================================== #
 
+            # Latest value of every loss, kept for callers such as sweep.py.
+            self.last_loss.update(loss)
+
             # Print out training information.
             if (i+1) % self.log_step == 0:
                 et = time.time() - start_time
@@ -375,18 +568,23 @@ class Solver(object):
                     for tag, value in loss.items():
                         self.logger.scalar_summary(tag, value, i+1)
 
+                # Memory per phase, exported to <log_dir>/memory.csv.
+                mem_stats = self.mem.log(i+1)
+                if mem_stats:
+                    print(', '.join('{}: {:.1f}'.format(tag, value) for tag, value in mem_stats.items()))
+                if self.use_tensorboard:
+                    for tag, value in mem_stats.items():
+                        self.logger.scalar_summary(tag, value, i+1)
+
             # Translate fixed images for debugging.
             if (i+1) % self.sample_step == 0:
                 with torch.no_grad():
-                    x_fake_list = [x_fixed]	
-                    for c_fixed in c_fixed_list:
-                        x_fake_list.append(self.G(x_fixed, c_fixed))
-                        #print(len(x_fake_list),'asdf')
-                    
-                    x_concat = torch.cat(x_fake_list, dim=3)
+                    x_sample = self.resize(x_fixed, stage_size)
+                    x_concat = self.sample_grid(x_sample, self.translate_fanout(x_sample, c_fixed))
                     sample_path = os.path.join(self.sample_dir, '{}-images.jpg'.format(i+1))
                     save_image(self.denorm(x_concat.data.cpu()), sample_path, nrow=1, padding=0)
                     print('Saved real and fake images into {}...'.format(sample_path))
+                self.mem.sample('sample')
 
             # Save model checkpoints.
             if (i+1) % self.model_save_step == 0:
@@ -395,7 +593,20 @@ class Solver(object):
                 D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(i+1))
                 torch.save(self.G.state_dict(), G_path)
                 torch.save(self.D.state_dict(), D_path)
+                stage_path = os.path.join(self.model_save_dir, '{}-stage.json'.format(i+1))
+                with open(stage_path, 'w') as f:
+                    json.dump({'stage': stage, 'image_size': stage_size}, f)
                 print('Saved model checkpoints into {}...'.format(self.model_save_dir))
+                self.mem.sample('save')
+
+                if self.eval_fid:
+                    scores = self.evaluate()
+                    print('Iteration [{}/{}], FID: {:.4f}, KID: {:.6f}'.format(
+                        i+1, self.num_iters, scores['eval/FID'], scores['eval/KID']))
+                    if self.use_tensorboard:
+                        for tag, value in scores.items():
+                            self.logger.scalar_summary(tag, value, i+1)
+                    self.mem.sample('eval')
 				
                 for j in range(0,len(D1)):
                     epochs.append(j)
@@ -479,10 +690,44 @@ class Solver(object):
                 print ('Decayed learning rates, g_lr: {}, d_lr: {}.'.format(g_lr, d_lr))
 
 
+    def fake_batches(self, num_images):
+        """Translate real images with the first attribute reversed, yielding the generated batches."""
+        num_fake = 0
+        with torch.no_grad():
+            for x_real, label_org in self.celeba_loader:
+                c_trg = label_org.clone()
+                c_trg[:, 0] = (label_org[:, 0] == 0)
+                yield self.G(x_real.to(self.device), c_trg.to(self.device))
+                num_fake += x_real.size(0)
+                if num_fake >= num_images:
+                    break
+
+    def real_data_id(self):
+        """Name the real images by dataset and a digest of their source files and crop size."""
+        if self.shard_dir:
+            sources = [os.path.abspath(self.shard_dir), file_digest(os.path.join(self.shard_dir, 'index.json'))]
+        else:
+            sources = [os.path.abspath(self.celeba_image_dir), file_digest(self.attr_path)]
+        digest = hashlib.sha256()
+        for value in sources + [str(self.celeba_crop_size)]:
+            digest.update(value.encode('utf-8'))
+        return '{}-{}'.format(self.dataset, digest.hexdigest()[:16])
+
+    def evaluate(self):
+        """Compute FID and KID of the current generator against cached real-image statistics."""
+        if self.evaluator is None:
+            self.evaluator = Evaluator(self.fid_extractor, self.fid_weights, self.fid_cache_dir, self.device)
+        # The loader's split is part of the cache key: train (flipped) and eval (unflipped) images differ.
+        split = self.celeba_loader.dataset.mode
+        self.evaluator.real_stats(self.celeba_loader, self.real_data_id(), split, self.image_size, self.fid_num_real)
+        fid, kid = self.evaluator.score(self.fake_batches(self.fid_num_fake))
+        return {'eval/FID': fid, 'eval/KID': kid}
+
     def test(self):
         """Translate images using StarGAN trained on a single dataset."""
         # Load the trained generator.
-        self.restore_model(self.test_iters)
+        self.load_generator()
+        self.check_discriminator('--mode test')
         
         # Set data loader.
         
@@ -501,7 +746,7 @@ class Solver(object):
                 z=0
                 #print(c_org)
                 out_src, out_cls = self.D(x_real)
-                if out_cls>0:
+                if out_cls[0, 0]>0:
                     c=1
                 else:
                     c=0
@@ -514,48 +759,40 @@ class Solver(object):
                 #print(c_org)
 				# Prepare input images and target domain labels.
                 
-                c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset,self.selected_attrs, mode='train')
-                #print(c_trg_list)
                 #out_src, out_cls = self.D(x_real)
                 #if out_cls>0:
                 #    c_trg_list=[0]
                 #else:
                 #    c_trg_list=[1]
                 # Translate images.
-                x_fake_list = [x_real]
-                for c_trg in c_trg_list:
-                    x_fake_list.append(self.G(x_real, c_trg))
-
-                    out_src, out_cls = self.D(x_real)
-                    #print(type(out_src),out_src.size())    #<class 'torch.Tensor'> torch.Size([16, 1, 2, 2])
-                    #print(out_src)
-                    #print(type(out_cls),out_cls.size())    # <class 'torch.Tensor'> torch.Size([16, 1])
-                    #print('Out_cls : ',out_cls,' i= ',i+1)
-                    x_reconst = self.G(x_real, c_trg)
-                    g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
-                    #g_loss_rec_max,max = torch.max(torch.abs(x_real - x_reconst))
+                # Translate into every target domain with one batched G forward.
+                x_fakes = self.translate_fanout(x_real, c_org)
+                # One score per image, averaged over the target domains, so extracted[i] is the i-th image.
+                g_loss_rec = torch.mean(torch.abs(x_real.unsqueeze(0) - x_fakes))
+                #g_loss_rec_max,max = torch.max(torch.abs(x_real - x_reconst))
 					
-                    #print('rahul ', g_loss_rec)
-                    batch_g['G/loss_rec'] = g_loss_rec.item()
+                #print('rahul ', g_loss_rec)
+                batch_g['G/loss_rec'] = g_loss_rec.item()
 						
-                    for tag, value in batch_g.items():
-                        value="{:.4f}".format(value)
-                        value=float(value)
-                        extracted.append(value)
-                        #print(value)
-                        if batch_loss>value:
-                            batch_loss=value
-                            z_min=i	
-                            #print('batch_loss : ',value)
-                        z=z+1
+                for tag, value in batch_g.items():
+                    value="{:.4f}".format(value)
+                    value=float(value)
+                    extracted.append(value)
+                    #print(value)
+                    if batch_loss>value:
+                        batch_loss=value
+                        z_min=i	
+                        #print('batch_loss : ',value)
+                    z=z+1
 						
 						
 						
                 # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
+                x_concat = self.sample_grid(x_real, x_fakes)
                 result_path = os.path.join(self.result_dir, '{}-images.jpg'.format(i+1))
                 save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
                 print('Saved real and fake images into {}...'.format(result_path))
+                self.mem.sample('test')
 			
             '''
 			extracted= [x_real]
@@ -590,7 +827,7 @@ class Solver(object):
                 z=0
                 #print(c_org)
                 out_src, out_cls = self.D(x_real)
-                if out_cls>0:
+                if out_cls[0, 0]>0:
                     c=1
                 else:
                     c=0
@@ -602,36 +839,14 @@ class Solver(object):
                 c_org=c_trg=c_trg.to(self.device)
 				
 				
-                c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
 
                 # Translate images.
-                x_fake_list = [x_real]
-                for c_trg in c_trg_list:
-                    x_fake_list.append(self.G(x_real, c_trg))
-
-					
-                    x_reconst = self.G(x_real, c_trg)
-                    g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
-                    #g_loss_rec_max,max = torch.max(torch.abs(x_real - x_reconst))
-					
-                    #print('rahul ', g_loss_rec)
-                    batch_g['G/loss_rec'] = g_loss_rec.item()
-						
-                    for tag, value in batch_g.items():
-                        value="{:.4f}".format(value)
-                        value=float(value)
-                        extracted.append(value)
-                        #print(value)
-                        if batch_loss>value:
-                            batch_loss=value
-                            z_min=i	
-                            #print('batch_loss : ',value)
-                        z=z+1
+                x_fakes = self.translate_fanout(x_real, c_org)
 						
 						
 						
                 # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
+                x_concat = self.sample_grid(x_real, x_fakes)
                 result_path = os.path.join('stargan_celeba1/results1/extracted/best', '{}-extracted-images.jpg'.format(i+1))
                 save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
                 print('Saved best 5 real and fake images into {}...'.format(result_path))
@@ -659,7 +874,7 @@ class Solver(object):
                 z=0
                 #print(c_org)
                 out_src, out_cls = self.D(x_real)
-                if out_cls>0:
+                if out_cls[0, 0]>0:
                     c=1
                 else:
                     c=0
@@ -671,36 +886,101 @@ class Solver(object):
                 c_org=c_trg=c_trg.to(self.device)
 				
 				
-                c_trg_list = self.create_labels(c_org, self.c_dim, self.dataset, self.selected_attrs)
 
                 # Translate images.
-                x_fake_list = [x_real]
-                for c_trg in c_trg_list:
-                    x_fake_list.append(self.G(x_real, c_trg))
-
-					
-                    x_reconst = self.G(x_real, c_trg)
-                    g_loss_rec = torch.mean(torch.abs(x_real - x_reconst))
-                    #g_loss_rec_max,max = torch.max(torch.abs(x_real - x_reconst))
-					
-                    #print('rahul ', g_loss_rec)
-                    batch_g['G/loss_rec'] = g_loss_rec.item()
-						
-                    for tag, value in batch_g.items():
-                        value="{:.4f}".format(value)
-                        value=float(value)
-                        extracted.append(value)
-                        #print(value)
-                        if batch_loss>value:
-                            batch_loss=value
-                            z_min=i	
-                            #print('batch_loss : ',value)
-                        z=z+1
+                x_fakes = self.translate_fanout(x_real, c_org)
 						
 						
 						
                 # Save the translated images.
-                x_concat = torch.cat(x_fake_list, dim=3)
+                x_concat = self.sample_grid(x_real, x_fakes)
                 result_path = os.path.join('stargan_celeba1/results1/extracted/worst', '{}-extracted-images.jpg'.format(i+1))
                 save_image(self.denorm(x_concat.data.cpu()), result_path, nrow=1, padding=0)
-                print('Saved worst 5 real and fake images into {}...'.format(result_path))
\ No newline at end of file
+                print('Saved worst 5 real and fake images into {}...'.format(result_path))
+
+        self.print_cache_stats()
+        mem_stats = self.mem.log(self.test_iters)
+        if mem_stats:
+            print(', '.join('{}: {:.1f}'.format(tag, value) for tag, value in mem_stats.items()))
+
+
+    def translate_frames(self, x, c_trg, x_key, y_key):
+        """Translate a batch of frames, reusing the last output for frames close to the last keyframe."""
+        # Frames are compared on 4x average-pooled thumbnails against the last frame sent through G.
+        thumbs = F.avg_pool2d(x, 4)
+        keys = []
+        source = []
+        for k in range(x.size(0)):
+            if x_key is None or torch.mean(torch.abs(thumbs[k] - x_key)) > self.video_threshold:
+                keys.append(k)
+                x_key = thumbs[k]
+            source.append(len(keys) - 1)
+
+        outputs = []
+        if keys:
+            x_real = x[keys].to(self.device)
+            y_fake = self.generate(x_real, c_trg.expand(len(keys), -1)).cpu()
+        for k in source:
+            outputs.append(y_key if k < 0 else y_fake[k])
+        if keys:
+            y_key = y_fake[-1]
+        return torch.stack(outputs), x_key, y_key, x.size(0) - len(keys)
+
+    def video_batches(self, reader):
+        """Decode and preprocess frames from a video reader, yielding batches of at most video_batch_size."""
+        from PIL import Image
+        from data_loader import get_transform
+
+        transform = None
+        frames = []
+        for frame in reader:
+            if transform is None:
+                crop_size = self.video_crop_size or min(frame.shape[0], frame.shape[1])
+                transform = get_transform('test', crop_size, self.image_size)
+            frames.append(transform(Image.fromarray(frame).convert('RGB')))
+            if len(frames) == self.video_batch_size:
+                yield torch.stack(frames)
+                frames = []
+        if frames:
+            yield torch.stack(frames)
+
+    def translate_video(self):
+        """Translate a local video file as a stream of frame batches."""
+        import imageio
+
+        self.load_generator()
+        self.check_discriminator('--mode video')
+        reader = imageio.get_reader(self.video_path)
+        writer = None
+        c_trg = None
+        x_key, y_key = None, None
+        num_frames, num_reused = 0, 0
+        start_time = time.time()
+        try:
+            fps = reader.get_meta_data().get('fps', 25)
+            writer = imageio.get_writer(self.video_out, fps=fps)
+            with torch.no_grad():
+                for x in self.video_batches(reader):
+                    if c_trg is None:
+                        # One target for the whole clip, from what D detects in the first frame.
+                        c_trg = self.flip_detected(x[:1].to(self.device))
+                    y, x_key, y_key, reused = self.translate_frames(x, c_trg, x_key, y_key)
+                    self.write_frames(writer, y)
+                    num_frames += x.size(0)
+                    num_reused += reused
+        finally:
+            # Finalize the container and stop ffmpeg even when a frame fails mid-clip.
+            if writer is not None:
+                writer.close()
+            reader.close()
+
+        et = time.time() - start_time
+        print('Translated {} frames ({} reused) into {} in {:.1f}s, {:.2f} frames/s.'.format(
+            num_frames, num_reused, self.video_out, et, num_frames / max(et, 1e-9)))
+        self.print_cache_stats()
+
+    def write_frames(self, writer, y):
+        """Encode a batch of generated frames into the output video stream."""
+        frames = self.denorm(y).mul(255).round().byte().permute(0, 2, 3, 1).numpy()
+        for frame in frames:
+            writer.append_data(frame)
@@ -0,0 +1,128 @@
+import os
+import copy
+import json
+import time
+import random
+import itertools
+import traceback
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+from torch.utils import data
+from solver import Solver
+from main import get_parser
+from main import str2bool
+from data_loader import SharedCelebA
+from data_loader import decode_dataset
+from data_loader import pin_process
+from data_loader import split_process_cpus
+
+
+# Decoded training set and thread budget of the current worker process.
+worker_state = {}
+
+
+def init_worker(images, labels, num_threads, cpu_queue):
+    """Attach a pool worker to the shared dataset and pin its threads and cores."""
+    worker_state['images'] = images
+    worker_state['labels'] = labels
+    pin_process(num_threads, cpu_queue)
+
+
+def run_trial(trial_id, config, overrides):
+    """Train one Solver with the given hyperparameter overrides and return its results row."""
+    config = copy.deepcopy(config)
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    trial_dir = os.path.join(config.sweep_dir, 'trial-{:03d}'.format(trial_id))
+    config.log_dir = os.path.join(trial_dir, 'logs')
+    config.model_save_dir = os.path.join(trial_dir, 'models')
+    config.sample_dir = os.path.join(trial_dir, 'samples')
+    config.result_dir = os.path.join(trial_dir, 'results')
+    config.use_tensorboard = False
+    for path in (config.log_dir, config.model_save_dir, config.sample_dir, config.result_dir):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    row = {'trial': trial_id}
+    row.update(overrides)
+    try:
+        dataset = SharedCelebA(worker_state['images'], worker_state['labels'], 'train')
+        celeba_loader = data.DataLoader(dataset=dataset, batch_size=config.batch_size, shuffle=True, num_workers=0)
+        solver = Solver(celeba_loader, config)
+
+        start_time = time.time()
+        solver.train()
+        et = time.time() - start_time
+    except Exception as e:
+        # Record the failure instead of losing every other trial's row.
+        traceback.print_exc()
+        row['status'] = 'failed'
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+        print('Trial {} failed: {}'.format(trial_id, row['error']))
+        return row
+
+    row['status'] = 'ok'
+    row['time'] = et
+    row['images/s'] = (config.num_iters - (config.resume_iters or 0)) * config.batch_size / et
+    row.update(solver.last_loss)
+    print('Finished trial {} in {:.1f}s...'.format(trial_id, et))
+    return row
+
+
+def get_trials(spec, num_trials):
+    """Expand a {name: [values]} spec into a full grid, or sample num_trials points from it."""
+    names = sorted(spec)
+    grid = [dict(zip(names, values)) for values in itertools.product(*[spec[name] for name in names])]
+    if num_trials is None:
+        return grid
+    return [dict((name, random.choice(spec[name])) for name in names) for _ in range(num_trials)]
+
+
+def main(config):
+    spec = json.loads(config.sweep_spec)
+    trials = get_trials(spec, config.num_trials)
+    print('Running {} trials on {} processes...'.format(len(trials), config.num_procs))
+    if not os.path.exists(config.sweep_dir):
+        os.makedirs(config.sweep_dir)
+
+    # Decode the training set once; trial processes share its pages.
+    images, labels = decode_dataset(config.celeba_image_dir, config.attr_path, config.selected_attrs,
+                                    config.celeba_crop_size, config.image_size)
+
+    ctx = mp.get_context('spawn')
+    config.num_threads, cpu_queue = split_process_cpus(ctx, config.num_procs, config.num_threads, config.pin_cpus)
+
+    pool = ctx.Pool(config.num_procs, initializer=init_worker,
+                    initargs=(images, labels, config.num_threads, cpu_queue))
+    try:
+        rows = pool.starmap(run_trial, [(k, config, trial) for k, trial in enumerate(trials)])
+    finally:
+        pool.close()
+        pool.join()
+
+    df = pd.DataFrame(rows)
+    num_failed = sum(row['status'] != 'ok' for row in rows)
+    if num_failed:
+        print('{} of {} trials failed; see the error column.'.format(num_failed, len(rows)))
+    results_path = os.path.join(config.sweep_dir, 'results.csv')
+    df.to_csv(results_path, index=False)
+    print(df.to_string(index=False))
+    print('Saved sweep results into {}...'.format(results_path))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+
+    # Sweep configuration.
+    parser.add_argument('--sweep_spec', type=str, required=True,
+                        help='JSON object of hyperparameter lists, e.g. \'{"lambda_cls": [1, 2], "d_lr": [1e-4, 5e-5]}\'')
+    parser.add_argument('--num_trials', type=int, default=None, help='sample this many random trials instead of the full grid')
+    parser.add_argument('--num_procs', type=int, default=2, help='number of trainings run concurrently')
+    parser.add_argument('--pin_cpus', type=str2bool, default=True,
+                        help='pin each trial process to its own --num_threads cores (default: cores / num_procs)')
+    parser.add_argument('--sweep_dir', type=str, default='stargan/sweep')
+
+    config = parser.parse_args()
+    print(config)
+    main(config)
@@ -0,0 +1,179 @@
+import os
+import time
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from solver import Solver
+from main import get_parser
+from main import str2bool
+from data_loader import get_transform
+from data_loader import pin_process
+from data_loader import split_process_cpus
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Solver, preprocessing and I/O threads of the current worker process.
+worker_state = {}
+
+
+def init_worker(config, cpu_queue):
+    """Load the shared read-only Generator once per worker and pin its threads and cores."""
+    config.use_tensorboard = False
+    pin_process(config.num_threads, cpu_queue)
+
+    solver = Solver(None, config)
+    solver.load_generator()
+    worker_state['solver'] = solver
+    worker_state['transform'] = get_transform('test', config.celeba_crop_size, solver.image_size)
+    worker_state['executor'] = ThreadPoolExecutor(config.io_threads)
+    worker_state['config'] = config
+
+
+def load_image(path):
+    """Return the preprocessed image, or the error message if it cannot be decoded."""
+    try:
+        return worker_state['transform'](Image.open(path).convert('RGB'))
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e).replace('\n', ' ')
+
+
+def save_image(args):
+    image, path = args
+    Image.fromarray(image).save(path, quality=95)
+
+
+def translate_chunk(files):
+    """Decode, translate and encode a chunk of files in batches; return the files written and the failures.
+
+    The I/O threads decode the next batch while G runs on the current one, and the encodes finish in
+    the background until the end of the chunk.
+    """
+    solver, config, executor = worker_state['solver'], worker_state['config'], worker_state['executor']
+    batches = [files[k:k+config.batch_size] for k in range(0, len(files), config.batch_size)]
+    written, failed, encodes = [], [], []
+    decodes = [executor.submit(load_image, os.path.join(config.input_dir, f)) for f in batches[0]] if batches else []
+    for k, names in enumerate(batches):
+        images = [future.result() for future in decodes]
+        if k + 1 < len(batches):
+            decodes = [executor.submit(load_image, os.path.join(config.input_dir, f)) for f in batches[k+1]]
+        batch, x_real = [], []
+        for f, image in zip(names, images):
+            # Skip undecodable files so one bad image does not fail the whole chunk.
+            if isinstance(image, str):
+                print('Failed to decode {}: {}'.format(f, image))
+                failed.append((f, image))
+            else:
+                batch.append(f)
+                x_real.append(image)
+        if not batch:
+            continue
+        x_real = torch.stack(x_real).to(solver.device)
+
+        with torch.no_grad():
+            if config.c_trg:
+                c_trg = torch.tensor([config.c_trg], device=solver.device).repeat(x_real.size(0), 1)
+            else:
+                c_trg = solver.flip_detected(x_real)
+            x_fake = solver.generate(x_real, c_trg)
+
+        # Keep the relative path and extension, so a.png and a.jpg do not overwrite each other.
+        images = solver.denorm(x_fake).mul(255).round().byte().permute(0, 2, 3, 1).cpu().numpy()
+        out_paths = [os.path.join(config.output_dir, f) for f in batch]
+        for path in out_paths:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        encodes += [executor.submit(save_image, args) for args in zip(images, out_paths)]
+        written += batch
+    for future in encodes:
+        future.result()
+    return written, failed
+
+
+def list_images(input_dir):
+    """Return the image files under input_dir as sorted relative paths."""
+    files = []
+    for root, _, names in os.walk(input_dir):
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                files.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(files)
+
+
+def main(config):
+    if not os.path.exists(config.output_dir):
+        os.makedirs(config.output_dir)
+
+    # Check here rather than in the workers, where a failing initializer is respawned forever.
+    if config.c_trg is None and config.export_path:
+        export = torch.load(config.export_path, map_location='cpu', mmap=True, weights_only=True)
+        if 'D' not in export:
+            raise ValueError('Flipping the detected attributes needs D, but {} was exported with --export_d false; '
+                             'pass --c_trg.'.format(config.export_path))
+
+    # Skip the files an interrupted run already wrote or failed to decode (delete failed.txt to retry those).
+    manifest_path = os.path.join(config.output_dir, 'manifest.txt')
+    failed_path = os.path.join(config.output_dir, 'failed.txt')
+    done = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            done = set(line.rstrip('\n') for line in f)
+    if os.path.exists(failed_path):
+        with open(failed_path, 'r') as f:
+            done.update(line.split('\t')[0] for line in f)
+    files = [f for f in list_images(config.input_dir) if f not in done]
+    chunks = [files[k:k+config.chunk_size] for k in range(0, len(files), config.chunk_size)]
+    print('Translating {} images ({} already done) on {} processes...'.format(len(files), len(done), config.num_procs))
+    if not files:
+        return
+
+    ctx = mp.get_context('spawn')
+    config.num_threads, cpu_queue = split_process_cpus(ctx, config.num_procs, config.num_threads, config.pin_cpus)
+
+    pool = ctx.Pool(config.num_procs, initializer=init_worker, initargs=(config, cpu_queue))
+    num_done = 0
+    num_failed = 0
+    start_time = time.time()
+    try:
+        with open(manifest_path, 'a') as manifest, open(failed_path, 'a') as failures:
+            for written, failed in pool.imap_unordered(translate_chunk, chunks):
+                manifest.write(''.join(f + '\n' for f in written))
+                manifest.flush()
+                failures.write(''.join('{}\t{}\n'.format(f, error) for f, error in failed))
+                failures.flush()
+                num_done += len(written)
+                num_failed += len(failed)
+                et = time.time() - start_time
+                print('Translated [{}/{}] images, {:.2f} images/s'.format(num_done, len(files), num_done / et))
+        pool.close()
+    except BaseException:
+        # Do not wait for the queued chunks after an error or an interrupt.
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    et = time.time() - start_time
+    print('Finished translating {} images in {:.1f}s, {:.2f} images/s.'.format(num_done, et, num_done / max(et, 1e-9)))
+    if num_failed:
+        print('Failed to decode {} images, listed in {}.'.format(num_failed, failed_path))
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+
+    # Bulk translation configuration.
+    parser.add_argument('--input_dir', type=str, required=True, help='directory of images to translate (searched recursively)')
+    parser.add_argument('--output_dir', type=str, required=True, help='translated images and manifest.txt go here')
+    parser.add_argument('--c_trg', type=float, nargs='+', default=None,
+                        help='fixed target label; by default flip the attributes D detects (needs D)')
+    parser.add_argument('--num_procs', type=int, default=max(1, os.cpu_count() or 1), help='number of worker processes')
+    parser.add_argument('--pin_cpus', type=str2bool, default=True,
+                        help='pin each worker to its own --num_threads cores (default: cores / num_procs)')
+    parser.add_argument('--io_threads', type=int, default=2, help='decode/encode threads per worker')
+    parser.add_argument('--chunk_size', type=int, default=256, help='images per work item and manifest update')
+
+    config = parser.parse_args()
+    print(config)
+    main(config)